@@ -1,60 +1,22 @@
 import yt_dlp
 import os
 
+from cli import download_urls
+
 
 def download_playlist_audio(playlist_url, save_path="downloads"):
     """
     Download audio from YouTube playlist with authentication options
-    """
-    # Create download directory if it doesn't exist
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
 
-    # Configuration options to avoid bot detection
-    ydl_opts = {
-        'format': 'bestaudio/best',  # Download best audio quality
-        'outtmpl': os.path.join(save_path, '%(title)s.%(ext)s'),  # Output filename template
-        'extractaudio': True,  # Extract audio
-        'audioformat': 'mp3',  # Convert to mp3
-        'ignoreerrors': True,  # Continue on download errors
-
-        # Anti-bot detection options
-        'cookiesfrombrowser': ('chrome',),  # Use cookies from Chrome browser
-        # Alternative: 'cookiesfrombrowser': ('firefox',),  # Use Firefox cookies
-        # Alternative: 'cookiesfrombrowser': ('safari',),   # Use Safari cookies
-
-        # Additional options to avoid detection
-        'sleep_interval': 1,  # Sleep between downloads
-        'max_sleep_interval': 5,  # Maximum sleep interval
-        'writeinfojson': False,  # Don't write info json
-        'writesubtitles': False,  # Don't write subtitles
-        'writeautomaticsub': False,  # Don't write auto subtitles
-
-        # User agent to mimic real browser
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-    }
-
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            print(f"Downloading playlist: {playlist_url}")
-            ydl.download([playlist_url])
+    Browser cookies (Chrome) are tried first, then entries are fetched without them.
+    """
+    print(f"Downloading playlist: {playlist_url}")
+    results = download_urls([playlist_url], 'playlist_audio', save_path)
+    for url, (status, detail) in results.items():
+        if status == 'completed':
             print("Download completed successfully!")
-    except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        print("\nTrying alternative method without browser cookies...")
-
-        # Fallback options without cookies
-        fallback_opts = ydl_opts.copy()
-        del fallback_opts['cookiesfrombrowser']
-
-        try:
-            with yt_dlp.YoutubeDL(fallback_opts) as ydl:
-                ydl.download([playlist_url])
-                print("Download completed with fallback method!")
-        except Exception as e2:
-            print(f"Fallback also failed: {str(e2)}")
+        else:
+            print(f"Error occurred: {detail}")
             print("\nPlease try one of the manual solutions mentioned below.")
 
 
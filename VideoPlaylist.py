@@ -1,25 +1,11 @@
-import yt_dlp
-import os
+from cli import download_urls
 
 def download_playlist_videos(playlist_url, save_path="."):
-    # Create the directory if it doesn't exist
-    os.makedirs(save_path, exist_ok=True)
-
-    ydl_opts = {
-        'format': 'bestvideo+bestaudio/best',  # Best video & audio quality
-        'merge_output_format': 'mp4',  # Ensure output is MP4 format
-        'outtmpl': f'{save_path}/%(playlist_title)s/%(title)s.%(ext)s',  # Save inside playlist folder
-        'force-ipv4': True,
-        'socket_timeout': 30,  # Timeout setting
-        'retries': 10,
-        'noplaylist': False,  # Ensure the entire playlist is downloaded
-    }
-
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([playlist_url])
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    # Files are saved inside a folder named after the playlist
+    results = download_urls([playlist_url], 'playlist_videos', save_path)
+    for url, (status, detail) in results.items():
+        if status != 'completed':
+            print(f"An error occurred: {detail}")
 
 if __name__ == "__main__":
     # Prompt the user for a playlist URL
@@ -1,286 +1,391 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, after_this_request
-import yt_dlp
+import time
+
+# Startup is timed from here, so it includes importing Flask and the engine
+_startup_began = time.monotonic()
+
+from flask import Flask, Response, render_template, request, jsonify, send_file, redirect, url_for, stream_with_context
+import json
 import os
+import socket
 import threading
 import uuid
 from datetime import datetime
+from urllib.parse import quote
 import shutil
 import tempfile
-import zipfile
+
+from engine import (BATCH_CONCURRENCY, DOWNLOAD_DIR, DOWNLOAD_FUNCTIONS, JOB_TTL, MAX_BATCH_URLS,
+                    MAX_PLAYLIST_CONCURRENCY, PLAYLIST_CONCURRENCY, TERMINAL_STATUSES, DownloadProgress,
+                    JOBS_REJECTED, JOBS_SUBMITTED, ZIP_BUILD_SECONDS, ZIP_BYTES, cancel_job, check_items,
+                    create_batch, detach_job, detached_view, discard_job, download_status, extraction_cache,
+                    files_owner, media_cache, metrics, notify_change, playlist_page, progress_broker,
+                    record_phase, refresh_batch, release_job, run_download, scheduler, submit_batch, submit_job,
+                    take_changed_jobs, throttle_status, track_changed_jobs, transfer_status, unique_urls,
+                    warm_ydl_pool)
+from job_store import open_job_store
+from scheduler import QueueFull
+from zipstream import ZipStream
 
 app = Flask(__name__)
+# Let a fronting proxy (e.g. nginx with X-Sendfile/X-Accel-Redirect) send finished files itself
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+# Most job IDs accepted by one batch status request
+MAX_BATCH_STATUS = 200
+# Open /events streams each hold a server thread; past this many, clients get a 503 and poll
+# instead, so half of gunicorn's threads stay free for other requests
+MAX_EVENT_STREAMS = int(os.environ.get('MAX_EVENT_STREAMS', int(os.environ.get('GUNICORN_THREADS', 64)) // 2))
+# Playlist entries per /info page, by default and at most
+INFO_PAGE_SIZE = 50
+MAX_INFO_PAGE_SIZE = 500
+# How long a progressive download request waits for the job to start writing its file
+PROGRESSIVE_START_TIMEOUT = int(os.environ.get('PROGRESSIVE_START_TIMEOUT', 30))
+
+# Upper bound for everything under DOWNLOAD_DIR, enforced by evicting finished jobs
+DOWNLOAD_DIR_MAX_BYTES = int(os.environ.get('DOWNLOAD_DIR_MAX_BYTES', 20 * 1024 ** 3))
+REAPER_INTERVAL = int(os.environ.get('REAPER_INTERVAL', 60))
+# Unknown directories younger than this may belong to a job still being created
+ORPHAN_GRACE_PERIOD = 300
+
+# Job records shared by all worker processes ('sqlite') or kept per process ('memory')
+JOB_STORE = os.environ.get('JOB_STORE', 'sqlite')
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', 'jobs.db')
+# How often local progress is written to the shared store
+STORE_FLUSH_INTERVAL = float(os.environ.get('STORE_FLUSH_INTERVAL', 1.0))
+# Unfinished jobs without a heartbeat for this long are re-queued by another worker
+STALE_JOB_SECONDS = int(os.environ.get('STALE_JOB_SECONDS', 30))
+# Build yt-dlp instances in the background at startup rather than for the first jobs
+WARM_UP = os.environ.get('WARM_UP', '1') != '0'
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+job_store = open_job_store(JOB_STORE, JOB_STORE_PATH)
+_event_streams = 0
+_event_streams_lock = threading.Lock()
+
+
+def job_from_row(row):
+    """Read-only DownloadProgress for a job owned by another worker process"""
+    progress = DownloadProgress(row['download_id'], row['download_type'])
+    for name in ('status', 'progress', 'filename', 'error', 'total_files', 'downloaded_files',
+                 'created_at', 'finished_at'):
+        setattr(progress, name, row[name])
+    options = json.loads(row['options'])
+    if row['download_type'] == 'batch':
+        progress.members = tuple(options.get('members', ()))
+    progress.alias_of = options.get('alias_of')
+    return progress
+
+
+def get_job(download_id):
+    """Progress for a job run by this process or, failing that, by any other worker"""
+    progress = download_status.get(download_id)
+    if progress is not None and progress.detached is not None:
+        # Still downloading for the jobs coalesced into it, but its own submitter left
+        return None if progress.detached == 'removed' else detached_view(progress)
+    if progress is None:
+        row = job_store.load(download_id)
+        if row is not None:
+            progress = job_from_row(row)
+    return progress
 
-# Create downloads directory if it doesn't exist
-DOWNLOAD_DIR = "downloads"
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
-
-# Store download status
-download_status = {}
-
-
-class DownloadProgress:
-    def __init__(self, download_id):
-        self.download_id = download_id
-        self.status = "starting"
-        self.progress = 0
-        self.filename = ""
-        self.error = None
-        self.total_files = 0
-        self.downloaded_files = 0
-
-
-def progress_hook(d, download_id):
-    """Progress hook for yt-dlp"""
-    if download_id in download_status:
-        if d['status'] == 'downloading':
-            if 'total_bytes' in d and d['total_bytes']:
-                download_status[download_id].progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
-            download_status[download_id].status = "downloading"
-            download_status[download_id].filename = os.path.basename(d.get('filename', ''))
-        elif d['status'] == 'finished':
-            download_status[download_id].downloaded_files += 1
-            download_status[download_id].filename = os.path.basename(d.get('filename', ''))
-            # Update progress based on files downloaded
-            if download_status[download_id].total_files > 0:
-                download_status[download_id].progress = (download_status[download_id].downloaded_files /
-                                                         download_status[download_id].total_files) * 100
-
-
-def get_playlist_info(url):
-    """Get playlist information to determine total number of videos"""
-    try:
-        ydl_opts = {
-            'quiet': True,
-            'extract_flat': True,
-            'force-ipv4': True,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if 'entries' in info:
-                return len(list(info['entries']))
-            else:
-                return 1  # Single video
-    except:
-        return 1
 
+@app.route('/')
+def index():
+    return render_template('index.html')
 
-def download_single_video(url, download_id):
-    try:
-        download_status[download_id].total_files = 1
 
-        ydl_opts = {
-            'outtmpl': f'{DOWNLOAD_DIR}/{download_id}/%(title)s.%(ext)s',
-            'format': 'bestvideo+bestaudio/best',
-            'merge_output_format': 'mp4',
-            'force-ipv4': True,
-            'socket_timeout': 30,
-            'retries': 10,
-            'progress_hooks': [lambda d: progress_hook(d, download_id)],
-        }
+def job_options(download_type, data):
+    """Options for DOWNLOAD_FUNCTIONS from a request body. Raises ValueError on bad input."""
+    options = {}
+    if download_type.startswith('playlist_'):
+        try:
+            concurrency = int(data.get('concurrency', PLAYLIST_CONCURRENCY))
+        except (TypeError, ValueError):
+            raise ValueError('concurrency must be a number')
+        options['concurrency'] = max(1, min(concurrency, MAX_PLAYLIST_CONCURRENCY))
+        # Sync mode only fetches entries missing from the playlist's download archive
+        options['sync'] = bool(data.get('sync', False))
+        # Part of the playlist: positions like "1-10,15" (yt-dlp's --playlist-items) and/or entry IDs
+        items = data.get('items')
+        if items:
+            if not isinstance(items, str):
+                raise ValueError('items must be a string such as "1-10,15"')
+            options['items'] = check_items(items.replace(' ', ''))
+        entry_ids = data.get('entry_ids')
+        if entry_ids:
+            if not isinstance(entry_ids, list) or not all(isinstance(i, str) for i in entry_ids):
+                raise ValueError('entry_ids must be a list of strings')
+            options['entry_ids'] = entry_ids
+    elif data.get('progressive'):
+        # /download/<id> can stream the file while it downloads
+        options['progressive'] = True
+    return options
+
+
+def queue_full_response(error):
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = '30'
+    return response, 503
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
 
-        download_status[download_id].status = "completed"
+@app.route('/download', methods=['POST'])
+def start_download():
+    data = request.json
+    url = data.get('url', '').strip()
+    download_type = data.get('type', 'single_video')
 
-    except Exception as e:
-        download_status[download_id].status = "error"
-        download_status[download_id].error = str(e)
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
 
+    if download_type not in DOWNLOAD_FUNCTIONS:
+        return jsonify({'error': 'Invalid download type'}), 400
 
-def download_single_audio(url, download_id):
     try:
-        download_status[download_id].total_files = 1
-
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': f'{DOWNLOAD_DIR}/{download_id}/%(title)s.%(ext)s',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'force-ipv4': True,
-            'socket_timeout': 30,
-            'retries': 10,
-            'progress_hooks': [lambda d: progress_hook(d, download_id)],
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-
-        download_status[download_id].status = "completed"
+        options = job_options(download_type, data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    except Exception as e:
-        download_status[download_id].status = "error"
-        download_status[download_id].error = str(e)
+    # Register the job and queue it, unless an identical one is already queued or running
+    def store(progress):
+        stored = dict(options, alias_of=progress.alias_of) if progress.alias_of else options
+        job_store.create(progress, url, stored, WORKER_ID)
+        created.append(progress.download_id)
 
-
-def download_playlist_videos(url, download_id):
+    created = []
+    try:
+        progress, shared_with = submit_job(download_type, url, options, on_create=store)
+    except QueueFull as e:
+        JOBS_REJECTED.inc(type=download_type)
+        for download_id in created:
+            job_store.delete(download_id)
+        return queue_full_response(e)
+
+    download_id = progress.download_id
+    JOBS_SUBMITTED.inc(type=download_type)
+    payload = {
+        'download_id': download_id,
+        'queue_position': scheduler.position(files_owner(progress)),
+    }
+    if shared_with is not None:
+        payload['shared_with'] = shared_with
+    return jsonify(payload)
+
+
+@app.route('/info')
+def playlist_info():
+    """One page of a playlist's entries: ?url=...&cursor=0&limit=50.
+
+    Pass the returned next_cursor to get the following page; it is null on the last one.
+    """
+    url = request.args.get('url', '').strip()
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
     try:
-        # Get playlist info first
-        total_files = get_playlist_info(url)
-        download_status[download_id].total_files = total_files
-
-        ydl_opts = {
-            'format': 'bestvideo+bestaudio/best',
-            'merge_output_format': 'mp4',  # Ensure output is MP4
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4',  # Convert to MP4 if not already
-            }],
-            'outtmpl': f'{DOWNLOAD_DIR}/{download_id}/%(playlist_title)s/%(title)s.%(ext)s',
-            'force-ipv4': True,
-            'socket_timeout': 30,
-            'retries': 10,
-            'noplaylist': False,  # This is crucial for playlist downloads
-            'yes_playlist': True,  # Explicitly enable playlist mode
-            'progress_hooks': [lambda d: progress_hook(d, download_id)],
-            # Add anti-bot detection options similar to AudioPlaylist2.py
-            'sleep_interval': 1,
-            'max_sleep_interval': 3,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
-
-        download_status[download_id].status = "completed"
+        cursor = max(0, int(request.args.get('cursor', 0)))
+        limit = max(1, min(int(request.args.get('limit', INFO_PAGE_SIZE)), MAX_INFO_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'cursor and limit must be numbers'}), 400
 
+    try:
+        return jsonify(playlist_page(url, cursor, limit))
     except Exception as e:
-        download_status[download_id].status = "error"
-        download_status[download_id].error = str(e)
+        return jsonify({'error': f'Error reading playlist: {str(e)}'}), 502
+
 
+@app.route('/download/batch', methods=['POST'])
+def start_batch_download():
+    """Queue many URLs as one batch: {"urls": [...], "type": ..., "batch_concurrency": n}.
+
+    Duplicate URLs are dropped. At most `batch_concurrency` of the batch's downloads
+    run at once, and /status/<batch_id> reports their combined progress.
+    """
+    data = request.get_json(silent=True) or {}
+    urls = data.get('urls')
+    download_type = data.get('type', 'single_video')
+
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        return jsonify({'error': 'urls must be a list of strings'}), 400
+    if download_type not in DOWNLOAD_FUNCTIONS:
+        return jsonify({'error': 'Invalid download type'}), 400
+
+    unique = unique_urls(urls)
+    if not unique:
+        return jsonify({'error': 'At least one URL is required'}), 400
+    if len(unique) > MAX_BATCH_URLS:
+        return jsonify({'error': f'At most {MAX_BATCH_URLS} URLs per batch'}), 400
 
-def download_playlist_audio(url, download_id):
     try:
-        # Get playlist info first
-        total_files = get_playlist_info(url)
-        download_status[download_id].total_files = total_files
-
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': f'{DOWNLOAD_DIR}/{download_id}/%(playlist_title)s/%(title)s.%(ext)s',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'force-ipv4': True,
-            'socket_timeout': 30,
-            'retries': 10,
-            'noplaylist': False,  # This is crucial for playlist downloads
-            'yes_playlist': True,  # Explicitly enable playlist mode
-            'ignoreerrors': True,  # Continue on download errors
-            'progress_hooks': [lambda d: progress_hook(d, download_id)],
-            # Add anti-bot detection options similar to AudioPlaylist2.py
-            'sleep_interval': 1,
-            'max_sleep_interval': 3,
-            'http_headers': {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) ApgleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-        }
-
-        # Try with browser cookies first (like in AudioPlaylist2.py)
-        try:
-            ydl_opts['cookiesfrombrowser'] = ('chrome',)
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-        except Exception as cookie_error:
-            print(f"Cookie method failed, trying without: {cookie_error}")
-            # Fallback without cookies
-            del ydl_opts['cookiesfrombrowser']
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-
-        download_status[download_id].status = "completed"
+        options = job_options(download_type, data)
+        concurrency = int(data.get('batch_concurrency', BATCH_CONCURRENCY))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    concurrency = max(1, min(concurrency, scheduler.workers))
 
-    except Exception as e:
-        download_status[download_id].status = "error"
-        download_status[download_id].error = str(e)
+    group, members = create_batch(unique, download_type)
+    job_store.create(group, '', {'members': list(group.members)}, WORKER_ID)
+    for progress, url in members:
+        job_store.create(progress, url, options, WORKER_ID)
 
+    try:
+        submit_batch(group, members, options, concurrency)
+    except QueueFull as e:
+        JOBS_REJECTED.inc(len(members), type=download_type)
+        for download_id in (group.download_id,) + group.members:
+            discard_job(download_id)
+            job_store.delete(download_id)
+        return queue_full_response(e)
+
+    JOBS_SUBMITTED.inc(len(members), type=download_type)
+    return jsonify({
+        'batch_id': group.download_id,
+        'jobs': [{'url': url, 'download_id': progress.download_id} for progress, url in members],
+        'duplicates': len([url for url in urls if url.strip()]) - len(unique),
+    })
 
-def create_zip_from_directory(directory_path, zip_filename):
-    """Create a zip file from a directory"""
-    with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Create relative path for zip
-                arcname = os.path.relpath(file_path, directory_path)
-                zipf.write(file_path, arcname)
 
+def status_payload(download_id, detail=False):
+    """JSON-ready status of a job, or None if it does not exist.
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+    With detail, jobs run by this process include their phase timeline.
+    """
+    progress = get_job(download_id)
+    if progress is None:
+        return None
+    payload = {
+        'status': progress.status,
+        'progress': progress.progress,
+        'filename': progress.filename,
+        'error': progress.error,
+        'total_files': progress.total_files,
+        'downloaded_files': progress.downloaded_files,
+        'downloading': progress.active_downloads,
+        'converting': progress.active_conversions,
+        'conversions': dict(progress.conversions),
+        'queue_position': scheduler.position(files_owner(progress)),
+        'estimated_wait': scheduler.estimated_wait(files_owner(progress)),
+    }
+    if progress.members:
+        payload['jobs'] = list(progress.members)
+    if progress.host and progress.status not in TERMINAL_STATUSES:
+        payload['throttle'] = throttle_status(progress)
+    if progress.transfer:
+        payload['transfer'] = transfer_status(progress)
+    owner = download_status.get(files_owner(progress)) if detail else None
+    if owner is not None and owner.timeline is not None:
+        payload['timeline'] = owner.timeline.snapshot()
+    return payload
 
 
-@app.route('/download', methods=['POST'])
-def start_download():
-    data = request.json
-    url = data.get('url', '').strip()
-    download_type = data.get('type', 'single_video')
+@app.route('/status/<download_id>')
+def get_status(download_id):
+    payload = status_payload(download_id, detail=request.args.get('detail') in ('1', 'true'))
+    if payload is None:
+        return jsonify({'error': 'Download not found'}), 404
 
-    if not url:
-        return jsonify({'error': 'URL is required'}), 400
+    return jsonify(payload)
 
-    # Generate unique download ID
-    download_id = str(uuid.uuid4())
-    download_status[download_id] = DownloadProgress(download_id)
 
-    # Create download directory for this session
-    session_dir = os.path.join(DOWNLOAD_DIR, download_id)
-    os.makedirs(session_dir, exist_ok=True)
-
-    # Start download in background thread
-    if download_type == 'single_video':
-        thread = threading.Thread(target=download_single_video, args=(url, download_id))
-    elif download_type == 'single_audio':
-        thread = threading.Thread(target=download_single_audio, args=(url, download_id))
-    elif download_type == 'playlist_videos':
-        thread = threading.Thread(target=download_playlist_videos, args=(url, download_id))
-    elif download_type == 'playlist_audio':
-        thread = threading.Thread(target=download_playlist_audio, args=(url, download_id))
+@app.route('/status', methods=['GET', 'POST'])
+def get_status_batch():
+    """Status of many jobs at once, via ?ids=a,b,c or a JSON body {"ids": [...]}"""
+    if request.method == 'POST':
+        ids = (request.get_json(silent=True) or {}).get('ids') or []
     else:
-        return jsonify({'error': 'Invalid download type'}), 400
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
 
-    thread.daemon = True
-    thread.start()
+    if not isinstance(ids, list):
+        return jsonify({'error': 'ids must be a list'}), 400
+    if len(ids) > MAX_BATCH_STATUS:
+        return jsonify({'error': f'At most {MAX_BATCH_STATUS} ids per request'}), 400
 
-    return jsonify({'download_id': download_id})
+    return jsonify({'jobs': {str(i): status_payload(str(i)) for i in ids}})
 
 
-@app.route('/status/<download_id>')
-def get_status(download_id):
+@app.route('/events/<download_id>')
+def status_events(download_id):
+    """Server-Sent Events stream that pushes a job's status whenever it changes"""
+    global _event_streams
+    if get_job(download_id) is None:
+        return jsonify({'error': 'Download not found'}), 404
+    with _event_streams_lock:
+        if _event_streams >= MAX_EVENT_STREAMS:
+            # The page falls back to polling /status when the stream fails
+            return jsonify({'error': 'Too many open event streams'}), 503, {'Retry-After': '30'}
+        _event_streams += 1
+
+    def stream_closed():
+        global _event_streams
+        with _event_streams_lock:
+            _event_streams -= 1
+
+    def generate():
+        version = progress_broker.version(download_id)
+        last_payload = None
+        idle = 0
+        while True:
+            payload = status_payload(download_id)
+            if payload is None:
+                yield 'event: gone\ndata: {}\n\n'
+                return
+            if payload != last_payload:
+                yield f'data: {json.dumps(payload)}\n\n'
+                last_payload = payload
+                idle = 0
+            if payload['status'] in TERMINAL_STATUSES:
+                return
+            if download_id in download_status:
+                new_version = progress_broker.wait(download_id, version, timeout=15)
+                changed = new_version != version
+                version = new_version
+            else:
+                # Run by another worker process, so follow it through the job store
+                time.sleep(STORE_FLUSH_INTERVAL)
+                idle += STORE_FLUSH_INTERVAL
+                changed = idle < 15
+                if not changed:
+                    idle = 0
+            if not changed:
+                yield ': keep-alive\n\n'
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    # Runs when the server is done with the response, whether or not it was streamed
+    response.call_on_close(stream_closed)
+    return response
+
+
+@app.route('/cancel/<download_id>', methods=['POST'])
+def cancel_download(download_id):
     if download_id not in download_status:
+        # Owned by another worker process, which picks the request up on its next flush
+        progress = get_job(download_id)
+        if progress is None:
+            return jsonify({'error': 'Download not found'}), 404
+        job_store.request_cancel(download_id)
+        return jsonify({'success': True, 'status': progress.status})
+
+    progress = cancel_job(download_id)
+    if progress is None:
         return jsonify({'error': 'Download not found'}), 404
-
-    progress = download_status[download_id]
-    return jsonify({
-        'status': progress.status,
-        'progress': progress.progress,
-        'filename': progress.filename,
-        'error': progress.error,
-        'total_files': progress.total_files,
-        'downloaded_files': progress.downloaded_files
-    })
+    return jsonify({'success': True, 'status': progress.status})
 
 
 @app.route('/download/<download_id>')
 def download_file(download_id):
-    if download_id not in download_status:
+    progress = get_job(download_id)
+    if progress is None:
         return jsonify({'error': 'Download not found'}), 404
 
-    progress = download_status[download_id]
+    if progress.progressive and progress.status not in TERMINAL_STATUSES:
+        return stream_in_progress(progress)
+
     if progress.status != 'completed':
         return jsonify({'error': 'Download not completed'}), 400
 
-    session_dir = os.path.join(DOWNLOAD_DIR, download_id)
+    session_dir = os.path.join(DOWNLOAD_DIR, files_owner(progress))
 
     # Count files in the directory
     total_files = 0
@@ -296,48 +401,310 @@ def download_file(download_id):
         # Single file - send directly
         file_path = files_list[0]
         original_filename = os.path.basename(file_path)
+        # Conditional: honours Range and If-Range, so interrupted downloads can resume
         return send_file(
             file_path,
             as_attachment=True,
             download_name=original_filename,
-            mimetype='application/octet-stream'
+            mimetype='application/octet-stream',
+            conditional=True,
+            etag=True,
         )
     else:
-        # Multiple files - create and send zip
+        # Multiple files - stream a store-only zip straight into the response
         zip_filename = f"{download_id}_playlist.zip"
-        zip_path = os.path.join(DOWNLOAD_DIR, zip_filename)
 
         try:
-            create_zip_from_directory(session_dir, zip_path)
-
-            @after_this_request
-            def remove_zip(response):
-                try:
-                    os.remove(zip_path)
-                except Exception:
-                    pass
-                return response
-
-            return send_file(
-                zip_path,
-                as_attachment=True,
-                download_name=zip_filename,
-                mimetype='application/zip'
-            )
-        except Exception as e:
+            archive = ZipStream.from_directory(session_dir)
+        except OSError as e:
             return jsonify({'error': f'Error creating zip file: {str(e)}'}), 500
 
+        return Response(
+            timed_zip_stream(archive, files_owner(progress)),
+            mimetype='application/zip',
+            headers={
+                'Content-Length': str(archive.size),
+                'Content-Disposition': f'attachment; filename="{zip_filename}"',
+            },
+        )
+
+
+def follow_file(progress, file_path, chunk_size=1024 * 1024):
+    """Bytes of a file as yt-dlp writes it, ending once the job finishes"""
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                yield chunk
+                continue
+            if progress.status in TERMINAL_STATUSES:
+                chunk = f.read()
+                if chunk:
+                    yield chunk
+                    continue
+                if progress.status != 'completed':
+                    # Breaking the connection tells the client the file is incomplete
+                    raise RuntimeError(f"Download {progress.download_id} {progress.status} while streaming")
+                return
+            time.sleep(0.25)
+
+
+def stream_in_progress(progress):
+    """Send a progressive job's file while it is still being downloaded"""
+    deadline = time.monotonic() + PROGRESSIVE_START_TIMEOUT
+    while progress.file_path is None or not os.path.exists(progress.file_path):
+        if progress.status in TERMINAL_STATUSES:
+            return download_file(progress.download_id)  # Finished (or failed) while we waited
+        if time.monotonic() > deadline:
+            return jsonify({'error': 'Download has not started yet'}), 409
+        time.sleep(0.25)
+
+    name = os.path.basename(progress.file_path)
+    fallback = name.encode('ascii', 'replace').decode().replace('"', "'")
+    headers = {
+        'Content-Disposition': f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}",
+        'Accept-Ranges': 'none',
+    }
+    if progress.total_bytes:
+        headers['Content-Length'] = str(progress.total_bytes)
+    return Response(follow_file(progress, progress.file_path), mimetype='application/octet-stream',
+                    headers=headers)
+
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify({
+        'extraction': extraction_cache.stats(),
+        'media': media_cache.stats(),
+    })
+
+
+def timed_zip_stream(archive, download_id):
+    started = time.monotonic()
+    for chunk in archive:
+        yield chunk
+    elapsed = time.monotonic() - started
+    ZIP_BUILD_SECONDS.observe(elapsed)
+    ZIP_BYTES.inc(archive.size)
+    record_phase(download_id, 'zip', time.time() - elapsed, bytes=archive.size, files=len(archive.members))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 @app.route('/cleanup/<download_id>', methods=['POST'])
 def cleanup_download(download_id):
-    if download_id in download_status:
-        del download_status[download_id]
+    remove_job(download_id)
+    return jsonify({'success': True})
+
+
+def remove_job(download_id, from_store=True):
+    """Forget a job (and, for a batch, its jobs) and delete its files once no other job shares them.
+
+    Returns the ID of the session directory that was deleted, or None.
+    """
+    progress = download_status.get(download_id)
+    if progress is None:
+        # Run by another worker process, which finds the row gone on its next flush and decides
+        # there whether the files can go: jobs coalesced into it may still need them
+        if from_store:
+            job_store.delete(download_id)
+        return None
+    unused = release_job(download_id)
+    if progress.alias_of is None and unused is None:
+        # Kept running for the jobs coalesced into it, which remove it when they go
+        detach_job(progress, 'removed')
+        progress_broker.forget(download_id)
+        if from_store:
+            job_store.delete(download_id)
+        return None
+    scheduler.cancel(download_id)
+    download_status.pop(download_id)
+    for member_id in progress.members:
+        remove_job(member_id, from_store)
+    progress_broker.forget(download_id)
+    if from_store:
+        job_store.delete(download_id)
+    if unused is None:
+        return None
+    if unused != download_id:
+        return remove_job(unused)  # The shared job, whose own submitter already left
 
     session_dir = os.path.join(DOWNLOAD_DIR, download_id)
     if os.path.exists(session_dir):
-        shutil.rmtree(session_dir)
+        shutil.rmtree(session_dir, ignore_errors=True)
+    return download_id
 
-    return jsonify({'success': True})
+
+def directory_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass  # Removed while we were walking
+    return total
+
+
+def is_job_id(name):
+    try:
+        return str(uuid.UUID(name)) == name
+    except ValueError:
+        return False
+
+
+def last_change(path):
+    """Newest modification time in a directory tree.
+
+    Directories count too: downloaded files get the server's Last-Modified
+    time, but creating or renaming them updates their directory.
+    """
+    newest = 0
+    for root, dirs, files in os.walk(path):
+        for name in [root] + [os.path.join(root, file) for file in files]:
+            try:
+                newest = max(newest, os.path.getmtime(name))
+            except OSError:
+                pass  # Removed while we were walking
+    return newest
+
+
+def reap_downloads():
+    """Expire finished jobs, delete orphaned directories and keep DOWNLOAD_DIR under budget"""
+    # Jobs whose submitter already left stay until the jobs coalesced into them go
+    released = {download_id for download_id in download_status.ids()
+                if getattr(download_status.get(download_id), 'detached', None) == 'removed'}
+    for download_id in download_status.expired():
+        if download_id not in released:
+            remove_job(download_id)
+    job_store.delete_expired(JOB_TTL)
+
+    # Directories of jobs run by other worker processes are not orphans
+    known_ids = download_status.ids() | job_store.ids()
+    now = time.time()
+    sizes = {}
+    for name in os.listdir(DOWNLOAD_DIR):
+        path = os.path.join(DOWNLOAD_DIR, name)
+        if name not in known_ids:
+            # Left behind by a restart or an abandoned tab. Only job directories are ours to
+            # delete: the command line and older scripts may save into the same directory,
+            # and a job directory the command line is still using keeps changing.
+            if is_job_id(name) and os.path.isdir(path) and now - last_change(path) > ORPHAN_GRACE_PERIOD:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        sizes[name] = directory_size(path)
+
+    total = sum(sizes.values())
+    for finished_at, download_id in download_status.finished():
+        if total <= DOWNLOAD_DIR_MAX_BYTES:
+            break
+        if download_id not in released:
+            total -= sizes.get(remove_job(download_id), 0)
+
+
+def reaper_loop():
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        try:
+            reap_downloads()
+        except Exception as e:
+            print(f"Reaper failed: {e}")
+
+
+def flush_job_store():
+    """Write changed local jobs to the shared store and apply cancellations from other workers"""
+    dirty = take_changed_jobs()
+    active = set()
+    finished = set()
+    for download_id in download_status.ids():
+        progress = download_status.get(download_id)
+        if progress is not None and progress.status not in TERMINAL_STATUSES:
+            active.add(download_id)
+            if progress.members:
+                # Some of a batch's jobs may run in other worker processes
+                refresh_batch(download_id, get_job)
+        elif progress is not None and progress.detached != 'removed':
+            finished.add(download_id)
+    # Running jobs are always written so their heartbeat stays fresh
+    jobs = [job for job in (download_status.get(i) for i in dirty | active) if job is not None]
+    # Other workers must see a detached job the way its submitter does here
+    jobs = [detached_view(job) if job.detached == 'cancelled' else job
+            for job in jobs if job.detached != 'removed']
+    gone = job_store.update_many(jobs, WORKER_ID) if jobs else set()
+    if finished - dirty:
+        # Finished jobs are not written again, so look for their rows separately
+        gone |= (finished - dirty) - job_store.ids()
+    for download_id in gone:
+        # Cleaned up through another worker, or claimed by one after we stalled
+        remove_job(download_id, from_store=False)
+
+    for download_id in job_store.cancel_requests(active):
+        cancel_job(download_id)
+
+
+def recover_interrupted_jobs():
+    """Re-queue unfinished jobs whose worker process died or restarted"""
+    for row in job_store.claim_interrupted(WORKER_ID, STALE_JOB_SECONDS, TERMINAL_STATUSES):
+        download_id = row['download_id']
+        progress = DownloadProgress(download_id, row['download_type'])
+        progress.created_at = row['created_at']
+        download_status[download_id] = progress
+        if row['download_type'] == 'batch':
+            # Nothing to run: its jobs are recovered on their own and the batch follows them
+            progress.members = job_from_row(row).members
+            progress.total_files = len(progress.members)
+            notify_change(download_id, force=True)
+            continue
+        os.makedirs(os.path.join(DOWNLOAD_DIR, download_id), exist_ok=True)
+        print(f"Re-queueing interrupted download {download_id}")
+        options = json.loads(row['options'])
+        # A coalesced job died with the job it shared, so it runs on its own now
+        options.pop('alias_of', None)
+        try:
+            # Partial .part files left in the session directory are resumed by yt-dlp
+            scheduler.submit(download_id, run_download, row['download_type'], row['url'],
+                             download_id, options)
+        except QueueFull as e:
+            progress.status = "error"
+            progress.error = str(e)
+            progress.finished_at = time.time()
+        notify_change(download_id, force=True)
+
+
+def job_store_loop():
+    last_recovery = 0
+    while True:
+        time.sleep(STORE_FLUSH_INTERVAL)
+        try:
+            flush_job_store()
+            if time.monotonic() - last_recovery > STALE_JOB_SECONDS:
+                last_recovery = time.monotonic()
+                recover_interrupted_jobs()
+        except Exception as e:
+            print(f"Job store sync failed: {e}")
+
+
+def warm_up():
+    # Importing yt-dlp and building its instances happens here instead of in the first request
+    try:
+        print(f"yt-dlp instances ready in {warm_ydl_pool():.2f}s")
+    except Exception as e:
+        print(f"Warming up yt-dlp failed: {e}")
+
+
+threading.Thread(target=reaper_loop, daemon=True, name="download-reaper").start()
+if job_store.shared:
+    track_changed_jobs()  # Only the shared store's flushes drain the set
+    threading.Thread(target=job_store_loop, daemon=True, name="job-store-sync").start()
+if WARM_UP:
+    threading.Thread(target=warm_up, daemon=True, name="ydl-warm-up").start()
+
+STARTUP_SECONDS = time.monotonic() - _startup_began
+metrics.gauge('downloader_startup_seconds', 'Time to import and set up the app', lambda: STARTUP_SECONDS)
+print(f"App started in {STARTUP_SECONDS:.2f}s")
 
 
 if __name__ == '__main__':
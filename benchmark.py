@@ -0,0 +1,269 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TERMINAL = ('completed', 'error', 'cancelled')
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Synthetic media files and RSS playlists that yt-dlp's generic extractor understands.
+
+    /media/<name>.mp4 is `file_size` bytes of video/mp4, and
+    /playlist/<name>.xml?entries=N is a feed of N such files.
+    """
+
+    file_size = 1024 ** 2
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, content_type, length, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _media(self, head):
+        start, end = 0, self.file_size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+        headers = [('Content-Range', f'bytes {start}-{end}/{self.file_size}')] if match else []
+        self._send(206 if match else 200, 'video/mp4', end - start + 1, headers)
+        if head:
+            return
+        chunk = b'\0' * 65536
+        remaining = end - start + 1
+        while remaining > 0:
+            self.wfile.write(chunk[:remaining])
+            remaining -= len(chunk)
+
+    def _playlist(self, name, entries):
+        host = f'http://{self.headers["Host"]}'
+        items = ''.join(
+            f'<item><title>{name} {i}</title><guid>{name}-{i}</guid>'
+            f'<enclosure url="{host}/media/{name}-{i}.mp4" type="video/mp4"/></item>'
+            for i in range(entries))
+        body = f'<?xml version="1.0"?><rss version="2.0"><channel><title>{name}</title>{items}</channel></rss>'
+        body = body.encode()
+        self._send(200, 'application/rss+xml', len(body))
+        self.wfile.write(body)
+
+    def _route(self, head):
+        path, _, query = self.path.partition('?')
+        if path.startswith('/media/') and path.endswith('.mp4'):
+            return self._media(head)
+        match = re.fullmatch(r'/playlist/([\w-]+)\.xml', path)
+        if match:
+            entries = int(dict(p.split('=', 1) for p in query.split('&') if '=' in p).get('entries', 5))
+            return self._playlist(match.group(1), entries)
+        self._send(404, 'text/plain', 0)
+
+    def do_GET(self):
+        self._route(head=False)
+
+    def do_HEAD(self):
+        self._route(head=True)
+
+
+def start_media_server(file_size):
+    MediaHandler.file_size = file_size
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='bench-media').start()
+    return server
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile in seconds, or None without values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[max(0, math.ceil(pct / 100 * len(values)) - 1)], 4)
+
+
+def run_job(client, url, download_type, poll_interval, options):
+    """Submit one job, wait for it and fetch its file. Returns a result dict."""
+    started = time.monotonic()
+    body = dict(options, url=url, type=download_type)
+    response = client.post('/download', json=body)
+    if response.status_code != 200:
+        return {'status': f'rejected {response.status_code}', 'latency': time.monotonic() - started}
+    download_id = response.json['download_id']
+    status = {}
+    while status.get('status') not in TERMINAL:
+        time.sleep(poll_interval)
+        status = client.get(f'/status/{download_id}').json
+    latency = time.monotonic() - started
+
+    result = {'status': status['status'], 'latency': latency, 'download_id': download_id}
+    if status['status'] == 'completed':
+        fetch_started = time.monotonic()
+        response = client.get(f'/download/{download_id}')
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+        result['fetch'] = time.monotonic() - fetch_started
+        result['bytes'] = size
+        result['zip'] = response.mimetype == 'application/zip'
+    return result
+
+
+def status_rps(app, download_ids, seconds, concurrency):
+    """Requests per second /status/<id> sustains with `concurrency` clients"""
+    deadline = time.monotonic() + seconds
+    counts = []
+
+    def hammer(worker):
+        client = app.test_client()
+        count = 0
+        while time.monotonic() < deadline:
+            client.get(f'/status/{download_ids[(worker + count) % len(download_ids)]}')
+            count += 1
+        counts.append(count)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=hammer, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.monotonic() - started)
+
+
+def summarize(results, wall, rps, startup):
+    latencies = [r['latency'] for r in results if r['status'] == 'completed']
+    zips = [r['fetch'] for r in results if r.get('zip')]
+    fetches = [r['fetch'] for r in results if 'fetch' in r and not r.get('zip')]
+    completed = len(latencies)
+    return {
+        'jobs': len(results),
+        'completed': completed,
+        'failed': len(results) - completed,
+        'wall_seconds': round(wall, 3),
+        'jobs_per_second': round(completed / wall, 3) if wall else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'file_fetch_p50': percentile(fetches, 50),
+        'zip_build_p50': percentile(zips, 50),
+        'zip_build_max': round(max(zips), 4) if zips else None,
+        'bytes_served': sum(r.get('bytes', 0) for r in results),
+        'status_rps': round(rps, 1) if rps is not None else None,
+        'startup_seconds': round(startup, 3),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def compare(report, baseline):
+    """Relative change of each numeric result against a previous report"""
+    changes = {}
+    for name, value in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before:
+            changes[name] = f'{(value - before) / before * 100:+.1f}%'
+    return changes
+
+
+def run_benchmark(args, base):
+    """Import the app, run the jobs against the media server at base and measure /status"""
+    import_started = time.monotonic()
+    import app as web
+    startup = time.monotonic() - import_started
+
+    def url_for_job(index):
+        name = 'same' if args.same_url else f'job{index}'
+        if args.type == 'playlist_videos':
+            return f'{base}/playlist/{name}.xml?entries={args.entries}'
+        return f'{base}/media/{name}.mp4'
+
+    clients = threading.local()
+
+    def job(index):
+        if not hasattr(clients, 'client'):
+            clients.client = web.app.test_client()
+        return run_job(clients.client, url_for_job(index), args.type, args.poll_interval, {})
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+        results = list(executor.map(job, range(args.jobs)))
+    wall = time.monotonic() - started
+
+    ids = [r['download_id'] for r in results if 'download_id' in r]
+    rps = status_rps(web.app, ids, args.status_seconds, args.concurrency) if ids and args.status_seconds else None
+    return {
+        'label': args.label,
+        'config': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+        'results': summarize(results, wall, rps, startup),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Offline end-to-end benchmark: a local media server, and the Flask app driven in-process.')
+    parser.add_argument('-n', '--jobs', type=int, default=20, help='jobs to run (default: 20)')
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+                        help='clients submitting and polling at the same time (default: 4)')
+    parser.add_argument('-t', '--type', default='single_video', choices=('single_video', 'playlist_videos'),
+                        help='job type; audio types need real media for ffmpeg (default: single_video)')
+    parser.add_argument('--entries', type=int, default=5, help='entries per playlist (default: 5)')
+    parser.add_argument('--file-size', type=int, default=1024 ** 2, help='bytes per media file (default: 1 MiB)')
+    parser.add_argument('--same-url', action='store_true',
+                        help='submit one URL repeatedly, so the caches serve most jobs')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='seconds between status polls')
+    parser.add_argument('--status-seconds', type=float, default=3,
+                        help='how long to measure /status throughput (0 to skip; default: 3)')
+    parser.add_argument('--label', default='', help='name stored in the report')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to print relative changes against')
+    args = parser.parse_args(argv)
+
+    # Everything the app writes goes to a scratch directory, and the local host is not rate limited
+    workdir = tempfile.mkdtemp(prefix='downloader-bench-')
+    os.environ.update({
+        'DOWNLOAD_DIR': os.path.join(workdir, 'downloads'),
+        'MEDIA_CACHE_DIR': os.path.join(workdir, 'media_cache'),
+        'ARCHIVE_DIR': os.path.join(workdir, 'archives'),
+        'JOB_STORE': 'memory',
+    })
+    for name, value in (('HOST_REQUEST_RATE', '1000'), ('HOST_MAX_RATE', '1000'), ('HOST_REQUEST_BURST', '1000')):
+        os.environ.setdefault(name, value)
+
+    server = start_media_server(args.file_size)
+    try:
+        # The app and yt-dlp log to stdout, which is kept for the report
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run_benchmark(args, f'http://127.0.0.1:{server.server_address[1]}')
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            report['changes'] = compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0 if report['results']['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import time
+
+from engine import (BATCH_CONCURRENCY, DOWNLOAD_DIR, DOWNLOAD_FUNCTIONS, MAX_PLAYLIST_CONCURRENCY,
+                    PLAYLIST_CONCURRENCY, TERMINAL_STATUSES, cancel_job, check_items, create_batch,
+                    download_status, read_url_list, submit_batch, unique_urls)
+
+
+def collect_files(download_id, output_dir):
+    """Move a finished job's files from its session directory into output_dir"""
+    session_dir = os.path.join(DOWNLOAD_DIR, download_id)
+    moved = []
+    for root, dirs, files in os.walk(session_dir):
+        for name in files:
+            source = os.path.join(root, name)
+            # Keep playlist folders, drop the session directory itself
+            destination = os.path.join(output_dir, os.path.relpath(source, session_dir))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(source, destination)
+            moved.append(destination)
+    shutil.rmtree(session_dir, ignore_errors=True)
+    return moved
+
+
+def print_progress(group):
+    sys.stderr.write(f"\r{group.downloaded_files}/{group.total_files} done, {group.progress:5.1f}% ")
+    sys.stderr.flush()
+
+
+def download_urls(urls, download_type='single_video', output_dir='downloads', concurrency=BATCH_CONCURRENCY,
+                  playlist_concurrency=PLAYLIST_CONCURRENCY, sync=False, quiet=False, items=None):
+    """Download URLs with the shared engine as one batch. Returns {url: (status, files or error)}."""
+    urls = unique_urls(urls)
+    if not urls:
+        return {}
+    options = {}
+    if download_type.startswith('playlist_'):
+        options = {'concurrency': max(1, min(playlist_concurrency, MAX_PLAYLIST_CONCURRENCY)), 'sync': sync}
+        if items:
+            options['items'] = items
+
+    group, members = create_batch(urls, download_type)
+    submit_batch(group, members, options, max(1, concurrency))
+    try:
+        while group.status not in TERMINAL_STATUSES:
+            if not quiet:
+                print_progress(group)
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        cancel_job(group.download_id)
+        raise
+    finally:
+        if not quiet:
+            sys.stderr.write('\n')
+
+    results = {}
+    for progress, url in members:
+        progress = download_status.pop(progress.download_id) or progress
+        if progress.status == 'completed':
+            results[url] = (progress.status, collect_files(progress.download_id, output_dir))
+        else:
+            shutil.rmtree(os.path.join(DOWNLOAD_DIR, progress.download_id), ignore_errors=True)
+            results[url] = (progress.status, progress.error)
+    download_status.pop(group.download_id)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download videos, audio and playlists with yt-dlp.')
+    parser.add_argument('urls', nargs='*', help='URLs to download (read from stdin when none are given)')
+    parser.add_argument('-t', '--type', default='single_video', choices=sorted(DOWNLOAD_FUNCTIONS),
+                        help='what to download (default: single_video)')
+    parser.add_argument('-f', '--file', action='append', default=[],
+                        help='read URLs from a file, one per line; "-" for stdin')
+    parser.add_argument('-o', '--output', default='downloads', help='output directory (default: downloads)')
+    parser.add_argument('-j', '--jobs', type=int, default=BATCH_CONCURRENCY,
+                        help=f'URLs downloaded at the same time (default: {BATCH_CONCURRENCY})')
+    parser.add_argument('-c', '--concurrency', type=int, default=PLAYLIST_CONCURRENCY,
+                        help=f'entries downloaded at the same time per playlist (default: {PLAYLIST_CONCURRENCY})')
+    parser.add_argument('--sync', action='store_true',
+                        help='only fetch playlist entries not downloaded by an earlier --sync run')
+    parser.add_argument('-I', '--items', type=check_items,
+                        help='only these playlist entries, by position, e.g. "1-10,15" or "-5:"')
+    parser.add_argument('-q', '--quiet', action='store_true', help='do not print progress')
+    args = parser.parse_args(argv)
+
+    urls = list(args.urls)
+    for path in args.file:
+        if path == '-':
+            urls += read_url_list(sys.stdin)
+        else:
+            with open(path, encoding='utf-8') as f:
+                urls += read_url_list(f)
+    if not urls and not args.file and not sys.stdin.isatty():
+        urls = read_url_list(sys.stdin)
+    if not urls:
+        parser.error('no URLs given')
+
+    # yt-dlp and the engine log to stdout, which is kept for the downloaded paths; -q drops the log
+    with contextlib.ExitStack() as stack:
+        log = stack.enter_context(open(os.devnull, 'w')) if args.quiet else sys.stderr
+        stack.enter_context(contextlib.redirect_stdout(log))
+        if args.quiet:
+            stack.enter_context(contextlib.redirect_stderr(log))
+        try:
+            results = download_urls(urls, args.type, args.output, args.jobs, args.concurrency, args.sync,
+                                    args.quiet, args.items)
+        except KeyboardInterrupt:
+            return 130
+
+    failed = 0
+    for url, (status, detail) in results.items():
+        if status == 'completed':
+            for path in detail:
+                print(path)
+        else:
+            failed += 1
+            print(f"{status}: {url}: {detail or ''}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+import threading
+import time
+
+
+def cookie_source(ydl_opts):
+    """Where ydl_opts take cookies from, or None when they use none"""
+    browser = ydl_opts.get('cookiesfrombrowser')
+    cookie_file = ydl_opts.get('cookiefile')
+    if browser is None and cookie_file is None:
+        return None
+    return (tuple(browser) if browser else None, cookie_file)
+
+
+class SharedCookieJars:
+    """Cookie jars loaded once per source and shared by every yt-dlp instance.
+
+    Reading a browser's cookie database is slow, so each source is read once
+    and reloaded in place when older than `max_age`, which lets instances that
+    already hold the jar see fresh cookies. A failed load is remembered for
+    `retry_after` seconds so every entry of a playlist does not repeat it.
+    """
+
+    def __init__(self, max_age=1800, retry_after=300):
+        self.max_age = max_age
+        self.retry_after = retry_after
+        self._jars = {}  # source -> [jar or None, loaded at, load error]
+        self._lock = threading.Lock()
+
+    def _load(self, source):
+        from yt_dlp.cookies import load_cookies
+
+        return load_cookies(source[1], source[0], None)
+
+    def get(self, ydl_opts):
+        """Shared jar for ydl_opts (None if they use no cookies). Raises CookieLoadError."""
+        source = cookie_source(ydl_opts)
+        if source is None:
+            return None
+        with self._lock:
+            item = self._jars.setdefault(source, [None, 0, None])
+            age = time.time() - item[1]
+            if item[2] is not None and age < self.retry_after:
+                raise item[2]
+            if item[0] is None or age > self.max_age:
+                self._reload(source, item)
+            if item[2] is not None:
+                raise item[2]
+            return item[0]
+
+    def refresh(self, ydl_opts, min_age=60):
+        """Reload the cookies for ydl_opts, e.g. after they were rejected, unless just loaded"""
+        source = cookie_source(ydl_opts)
+        with self._lock:
+            item = self._jars.get(source)
+            if item is not None and item[0] is not None and time.time() - item[1] > min_age:
+                self._reload(source, item)
+
+    def _reload(self, source, item):
+        # Called with the lock held
+        item[1] = time.time()
+        try:
+            fresh = self._load(source)
+        except Exception as e:
+            if item[0] is None:
+                item[2] = e
+                print(f"Could not load cookies: {e.__context__ or e}")
+            else:
+                print(f"Reloading cookies failed, keeping the previous ones: {e}")
+            return
+        item[2] = None
+        if item[0] is None:
+            item[0] = fresh
+            return
+        # Update the existing jar so instances holding it pick up the new cookies
+        item[0].clear()
+        for cookie in fresh:
+            item[0].set_cookie(cookie)
+
+    def available(self, ydl_opts):
+        """False while loading the cookies for ydl_opts is known to fail"""
+        try:
+            self.get(ydl_opts)
+        except Exception:
+            return False
+        return True
@@ -0,0 +1,47 @@
+import hashlib
+import os
+import threading
+
+from extraction_cache import normalize_url
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def entry_id(entry):
+    """ID of a flat playlist entry"""
+    # Some extractors (e.g. RSS feeds) give flat entries no id, fall back to their URL
+    return entry.get('id') or normalize_url(entry.get('url') or entry.get('webpage_url') or '')
+
+
+def entry_archive_id(entry):
+    """yt-dlp style archive line ("<extractor> <id>") for a flat playlist entry"""
+    extractor = (entry.get('ie_key') or 'generic').lower()
+    return f'{extractor} {entry_id(entry)}'
+
+
+class DownloadArchive:
+    """Persistent record of the playlist entries already delivered for one playlist.
+
+    Uses yt-dlp's --download-archive file format, one "<extractor> <id>" per line.
+    """
+
+    def __init__(self, directory, playlist_url, download_type):
+        key = hashlib.sha1(f'{download_type} {normalize_url(playlist_url)}'.encode('utf-8')).hexdigest()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{key}.txt')
+        with _locks_guard:
+            self._lock = _locks.setdefault(self.path, threading.Lock())
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def add_many(self, archive_ids):
+        if not archive_ids:
+            return
+        # One append per call, so other worker processes never see partial lines
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(archive_id + '\n' for archive_id in archive_ids))
@@ -0,0 +1,1262 @@
+import contextlib
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures
+
+from cookie_jar import SharedCookieJars, cookie_source
+from download_archive import DownloadArchive, entry_archive_id, entry_id
+from extraction_cache import ExtractionCache, normalize_url
+from fragment_tuner import FragmentTuner, is_fragmented
+from job_registry import JobRegistry
+from job_trace import JobProfiler, JobTimeline, TraceLog
+from media_cache import MediaCache
+from metrics import Registry
+from progress_events import ProgressBroker
+from scheduler import DownloadScheduler, QueueFull
+from throttle import BandwidthGovernor, HostThrottle, is_throttled, url_host
+from transcoder import (METHOD_NONE, METHOD_REMUX, METHOD_TRANSCODE, SUPPORTED_POSTPROCESSORS,
+                        TranscodeCancelled, TranscodePool, convert)
+from ydl_pool import YoutubeDLPool
+
+# Create downloads directory if it doesn't exist
+DOWNLOAD_DIR = os.environ.get('DOWNLOAD_DIR', 'downloads')
+if not os.path.exists(DOWNLOAD_DIR):
+    os.makedirs(DOWNLOAD_DIR)
+
+# Number of downloads that run at the same time, and how many may wait for a slot
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 4))
+MAX_QUEUE = int(os.environ.get('MAX_QUEUE', 50))
+
+# Playlist entries downloaded at the same time within one job
+PLAYLIST_CONCURRENCY = int(os.environ.get('PLAYLIST_CONCURRENCY', 3))
+MAX_PLAYLIST_CONCURRENCY = int(os.environ.get('MAX_PLAYLIST_CONCURRENCY', 8))
+
+# How long flat playlist extractions are reused, and how many are kept
+EXTRACTION_CACHE_TTL = int(os.environ.get('EXTRACTION_CACHE_TTL', 600))
+EXTRACTION_CACHE_SIZE = int(os.environ.get('EXTRACTION_CACHE_SIZE', 256))
+
+# Finished media shared between jobs, evicted least recently used past the byte budget
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', 'media_cache')
+MEDIA_CACHE_BYTES = int(os.environ.get('MEDIA_CACHE_BYTES', 10 * 1024 ** 3))
+# yt-dlp options that change the produced file, and therefore the cache key
+MEDIA_CACHE_KEY_OPTIONS = ('format', 'merge_output_format', 'postprocessors')
+
+# Prefer audio streams whose codec can be delivered with a stream copy (AAC, Opus, MP3)
+AUDIO_FORMAT = "bestaudio[acodec~='^(mp4a|opus|mp3)']/bestaudio/best"
+# Copies those streams into their own container and only re-encodes anything else to 192k mp3
+AUDIO_POSTPROCESSOR = {'key': 'FFmpegExtractAudio', 'preferredcodec': 'best', 'preferredquality': '192'}
+
+# Fragments (DASH/HLS) fetched at once: starts at FRAGMENT_CONCURRENCY per host and is tuned
+# between 1 and MAX_FRAGMENT_CONCURRENCY from measured throughput
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', 4))
+MAX_FRAGMENT_CONCURRENCY = int(os.environ.get('MAX_FRAGMENT_CONCURRENCY', 16))
+# Plain HTTP downloads are requested in ranges of this size (0 for one request), read in BUFFER_SIZE blocks at first
+HTTP_CHUNK_SIZE = int(os.environ.get('HTTP_CHUNK_SIZE', 10 * 1024 ** 2))
+BUFFER_SIZE = int(os.environ.get('BUFFER_SIZE', 64 * 1024))
+
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/91.0.4472.124 Safari/537.36')
+# yt-dlp options shared by every download type
+COMMON_OPTIONS = {
+    'force-ipv4': True,
+    'socket_timeout': 30,
+    'retries': 10,
+    'http_chunk_size': HTTP_CHUNK_SIZE or None,
+    'buffersize': BUFFER_SIZE,
+}
+# yt-dlp options per download type, used by the web app and the command line alike
+OPTION_PROFILES = {
+    'single_video': {
+        'format': 'bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4',
+    },
+    'single_audio': {
+        'format': AUDIO_FORMAT,
+        'postprocessors': [AUDIO_POSTPROCESSOR],
+    },
+    'playlist_videos': {
+        'format': 'bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4',  # Ensure output is MP4
+        'postprocessors': [{
+            'key': 'FFmpegVideoRemuxer',
+            'preferedformat': 'mp4',  # Merged files already are; single-file formats are stream-copied
+        }],
+        # Add anti-bot detection options similar to AudioPlaylist2.py; request pacing is up to host_throttle
+        'http_headers': {'User-Agent': USER_AGENT},
+    },
+    'playlist_audio': {
+        'format': AUDIO_FORMAT,
+        'postprocessors': [AUDIO_POSTPROCESSOR],
+        'ignoreerrors': True,  # Continue on download errors
+        # Try with browser cookies first (like in AudioPlaylist2.py)
+        'cookiesfrombrowser': ('chrome',),
+        'http_headers': {'User-Agent': USER_AGENT},
+    },
+}
+
+# Progressive jobs pick a single-file format and skip postprocessing, so the file can be
+# streamed to the client while yt-dlp writes it
+PROGRESSIVE_FORMATS = {
+    'single_video': 'best',
+    'single_audio': 'bestaudio/best',
+}
+
+# ffmpeg conversions of playlist entries run beside the downloads, at most this many at once;
+# downloads wait once TRANSCODE_BACKLOG more are waiting for ffmpeg
+TRANSCODE_WORKERS = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 1))
+TRANSCODE_BACKLOG = int(os.environ.get('TRANSCODE_BACKLOG', 2 * TRANSCODE_WORKERS))
+
+# Minimum seconds between pushed progress updates for one job
+PROGRESS_PUSH_INTERVAL = float(os.environ.get('PROGRESS_PUSH_INTERVAL', 0.5))
+# Per-playlist records of delivered entries, used by sync mode
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archives')
+
+# Batches: many URLs submitted at once, run as one group that shares a concurrency limit
+MAX_BATCH_URLS = int(os.environ.get('MAX_BATCH_URLS', 50))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 2))
+
+# Idle yt-dlp instances kept for reuse per option set
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', MAX_PLAYLIST_CONCURRENCY))
+# Options used to expand playlists into flat entries
+FLAT_EXTRACT_OPTIONS = {
+    'quiet': True,
+    'extract_flat': 'in_playlist',
+    'force-ipv4': True,
+}
+
+# Browser cookies are read once and shared; reloaded when older than COOKIE_MAX_AGE,
+# and a failed read is not retried for COOKIE_RETRY_AFTER seconds
+COOKIE_MAX_AGE = int(os.environ.get('COOKIE_MAX_AGE', 1800))
+COOKIE_RETRY_AFTER = int(os.environ.get('COOKIE_RETRY_AFTER', 300))
+# Tries per playlist entry, switching between cookies and none, with a delay doubling from ENTRY_RETRY_DELAY
+ENTRY_ATTEMPTS = int(os.environ.get('ENTRY_ATTEMPTS', 3))
+ENTRY_RETRY_DELAY = float(os.environ.get('ENTRY_RETRY_DELAY', 2))
+
+# Requests per second to one host, adapted between HOST_MIN_RATE and HOST_MAX_RATE:
+# halved and paused for THROTTLE_PAUSE seconds on a 403/429, raised a little after each success
+HOST_REQUEST_RATE = float(os.environ.get('HOST_REQUEST_RATE', 2))
+HOST_REQUEST_BURST = int(os.environ.get('HOST_REQUEST_BURST', 3))
+HOST_MIN_RATE = float(os.environ.get('HOST_MIN_RATE', 0.05))
+HOST_MAX_RATE = float(os.environ.get('HOST_MAX_RATE', 10))
+THROTTLE_PAUSE = float(os.environ.get('THROTTLE_PAUSE', 10))
+# Bytes per second shared by all downloads, split evenly between jobs (0 for no limit)
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', 0))
+
+# JSON-lines file every job phase is appended to (empty: no trace log)
+TRACE_LOG = os.environ.get('TRACE_LOG', '')
+# Timeline events kept per job for /status/<id>?detail=1
+TIMELINE_MAX_EVENTS = int(os.environ.get('TIMELINE_MAX_EVENTS', 500))
+# Fraction of jobs run under cProfile, their stats saved as PROFILE_DIR/<job id>.prof
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# Finished jobs (status and files) are kept this long before the reaper removes them
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))
+MAX_JOB_RECORDS = int(os.environ.get('MAX_JOB_RECORDS', 1000))
+
+# Store download status
+download_status = JobRegistry(ttl=JOB_TTL, max_jobs=MAX_JOB_RECORDS)
+# Jobs changed since take_changed_jobs() last ran; None unless a shared job store needs them
+_dirty_jobs = None
+_dirty_jobs_lock = threading.Lock()
+# Unfinished jobs by (normalized URL, type, options), so identical submissions share one download
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+scheduler = DownloadScheduler(workers=MAX_WORKERS, max_queue=MAX_QUEUE)
+extraction_cache = ExtractionCache(max_entries=EXTRACTION_CACHE_SIZE, ttl=EXTRACTION_CACHE_TTL)
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_BYTES)
+progress_broker = ProgressBroker(min_interval=PROGRESS_PUSH_INTERVAL)
+transcode_pool = TranscodePool(workers=TRANSCODE_WORKERS, backlog=TRANSCODE_BACKLOG)
+cookie_jars = SharedCookieJars(max_age=COOKIE_MAX_AGE, retry_after=COOKIE_RETRY_AFTER)
+ydl_pool = YoutubeDLPool(max_idle=YDL_POOL_SIZE, cookie_jars=cookie_jars)
+host_throttle = HostThrottle(rate=HOST_REQUEST_RATE, burst=HOST_REQUEST_BURST, min_rate=HOST_MIN_RATE,
+                             max_rate=HOST_MAX_RATE, pause=THROTTLE_PAUSE)
+bandwidth = BandwidthGovernor(limit=BANDWIDTH_LIMIT)
+trace_log = TraceLog(TRACE_LOG) if TRACE_LOG else None
+job_profiler = JobProfiler(PROFILE_DIR, PROFILE_SAMPLE_RATE)
+fragment_tuner = FragmentTuner(initial=FRAGMENT_CONCURRENCY, maximum=MAX_FRAGMENT_CONCURRENCY)
+
+TERMINAL_STATUSES = ('completed', 'error', 'cancelled')
+# What a coalesced job copies from the job it shares
+SHARED_FIELDS = ('status', 'progress', 'filename', 'error', 'total_files', 'downloaded_files', 'active_downloads',
+                 'active_conversions', 'conversions', 'host', 'progressive', 'file_path', 'total_bytes',
+                 'transfer', 'finished_at')
+
+metrics = Registry()
+JOBS_SUBMITTED = metrics.counter('downloader_jobs_submitted_total', 'Jobs accepted into the queue', ['type'])
+JOBS_COALESCED = metrics.counter('downloader_jobs_coalesced_total',
+                                 'Jobs attached to an identical job already queued or running', ['type'])
+JOBS_REJECTED = metrics.counter('downloader_jobs_rejected_total', 'Jobs refused because the queue was full', ['type'])
+JOBS_FINISHED = metrics.counter('downloader_jobs_finished_total', 'Jobs that stopped running', ['type', 'status'])
+JOB_DURATION = metrics.histogram('downloader_job_duration_seconds', 'Run time of a job, excluding queueing', ['type'])
+QUEUE_WAIT = metrics.histogram('downloader_queue_wait_seconds', 'Time jobs spent waiting for a worker', ['type'])
+DOWNLOADED_BYTES = metrics.counter('downloader_downloaded_bytes_total', 'Media bytes received', ['type'])
+PHASE_SECONDS = metrics.histogram('downloader_phase_seconds', 'Time spent per job phase', ['phase'])
+POSTPROCESSOR_SECONDS = metrics.histogram('downloader_postprocessor_seconds',
+                                          'Time spent in yt-dlp postprocessors (ffmpeg)', ['postprocessor'])
+CONVERSIONS = metrics.counter('downloader_conversions_total', 'Files left as is, remuxed or transcoded',
+                              ['postprocessor', 'method'])
+YDL_SETUP_SECONDS = metrics.histogram('downloader_ydl_setup_seconds', 'Time to get a yt-dlp instance for a job',
+                                      ['instance'], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+ENTRY_RETRIES = metrics.counter('downloader_entry_retries_total', 'Playlist entries tried again after failing',
+                                ['cookies'])
+THROTTLE_WAIT = metrics.histogram('downloader_throttle_wait_seconds', 'Time requests waited for their host',
+                                  buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60))
+THROTTLE_BACKOFFS = metrics.counter('downloader_throttle_backoffs_total', 'Requests answered with 403 or 429')
+ERRORS = metrics.counter('downloader_errors_total', 'Failed jobs and skipped entries', ['exception'])
+ZIP_BUILD_SECONDS = metrics.histogram('downloader_zip_build_seconds', 'Time to stream a playlist zip')
+ZIP_BYTES = metrics.counter('downloader_zip_bytes_total', 'Bytes sent as playlist zips')
+metrics.gauge('downloader_queue_depth', 'Jobs waiting for a worker', lambda: scheduler.stats()['queued'])
+metrics.gauge('downloader_active_jobs', 'Jobs currently running', lambda: scheduler.stats()['running'])
+metrics.gauge('downloader_workers', 'Size of the download worker pool', lambda: scheduler.workers)
+metrics.gauge('downloader_tracked_jobs', 'Job records held in memory', lambda: len(download_status))
+metrics.gauge('downloader_media_cache_bytes', 'Bytes held in the media cache',
+              lambda: media_cache.stats()['bytes'])
+metrics.gauge('downloader_ydl_idle_instances', 'yt-dlp instances waiting to be reused',
+              lambda: ydl_pool.stats()['idle'])
+metrics.gauge('downloader_transcodes_running', 'ffmpeg conversions in progress',
+              lambda: transcode_pool.stats()['running'])
+metrics.gauge('downloader_transcodes_queued', 'Downloaded entries waiting for ffmpeg',
+              lambda: transcode_pool.stats()['queued'])
+
+# Last downloaded_bytes seen per (job, file), to turn hook snapshots into byte counts
+_hook_bytes = {}
+_hook_bytes_lock = threading.Lock()
+# Start time of running postprocessors per (job, thread, postprocessor)
+_postprocessor_started = {}
+
+
+class DownloadProgress:
+    __slots__ = ('download_id', 'download_type', 'status', 'progress', 'filename', 'error',
+                 'total_files', 'downloaded_files', 'active_downloads', 'active_conversions',
+                 'conversions', 'group_id', 'members', 'host', 'progressive', 'file_path', 'total_bytes',
+                 'transfer', 'alias_of', 'subscribers', 'detached', 'detached_at', 'timeline', 'created_at',
+                 'finished_at')
+
+    def __init__(self, download_id, download_type=None):
+        self.download_id = download_id
+        self.download_type = download_type
+        self.status = "queued"
+        self.progress = 0
+        self.filename = ""
+        self.error = None
+        self.total_files = 0
+        self.downloaded_files = 0
+        # Playlist entries currently in each pipeline stage
+        self.active_downloads = 0
+        self.active_conversions = 0
+        self.conversions = {}  # file name -> how ffmpeg produced it (none, remux or transcode)
+        self.group_id = None  # Batch this job belongs to
+        self.members = ()  # For a batch, the IDs of its jobs
+        self.host = None  # Host of the URL being downloaded, for throttling
+        # Progressive jobs: the file being written and its expected size, for streaming it early
+        self.progressive = False
+        self.file_path = None
+        self.total_bytes = None
+        # Download settings in use, and bytes and seconds of finished downloads
+        self.transfer = {}
+        # A coalesced job follows the job it shares (alias_of); that job counts who still wants
+        # its files, itself included
+        self.alias_of = None
+        self.subscribers = {download_id}
+        # Set when this job's own submitter cancelled ('cancelled') or cleaned up ('removed') while
+        # the download kept running for others; the submitter then sees detached_view() instead
+        self.detached = None
+        self.detached_at = None
+        self.timeline = None  # JobTimeline, once the job runs in this process
+        self.created_at = time.time()
+        self.finished_at = None
+
+
+def notify_change(download_id, force=False):
+    """Tell subscribers and the job store that a job changed"""
+    progress_broker.publish(download_id, force=force)
+    mark_changed(download_id)
+    progress = download_status.get(download_id)
+    if progress is not None and has_followers(progress):
+        share_progress(progress, force)
+    if progress is not None and progress.group_id is not None:
+        refresh_batch(progress.group_id)
+
+
+def track_changed_jobs():
+    """Start collecting changed jobs for take_changed_jobs(), which must then drain them"""
+    global _dirty_jobs
+    with _dirty_jobs_lock:
+        if _dirty_jobs is None:
+            _dirty_jobs = set()
+
+
+def mark_changed(download_id):
+    with _dirty_jobs_lock:
+        if _dirty_jobs is not None:
+            _dirty_jobs.add(download_id)
+
+
+def take_changed_jobs():
+    """IDs of jobs changed since the last call"""
+    with _dirty_jobs_lock:
+        changed = set(_dirty_jobs or ())
+        if _dirty_jobs is not None:
+            _dirty_jobs.clear()
+    return changed
+
+
+def record_phase(download_id, phase, started, ended=None, **fields):
+    """Add a phase to a job's timeline, if the job runs in this process"""
+    progress = download_status.get(download_id)
+    if progress is not None and progress.timeline is not None:
+        progress.timeline.record(phase, started, ended, **fields)
+
+
+@contextlib.contextmanager
+def timed_phase(download_id, phase, **fields):
+    """Record the block as a phase; it can add fields (e.g. bytes) to the dict it gets"""
+    started = time.time()
+    try:
+        yield fields
+    except BaseException:
+        fields['failed'] = True
+        raise
+    finally:
+        record_phase(download_id, phase, started, **fields)
+
+
+def ydl_options(download_type, download_id, progressive=False):
+    """Fresh yt-dlp options for one job of the given type"""
+    ydl_opts = dict(COMMON_OPTIONS, **copy.deepcopy(OPTION_PROFILES[download_type]))
+    ydl_opts['postprocessor_hooks'] = [lambda d: postprocessor_hook(d, download_id)]
+    if progressive:
+        # One file, written under its final name and delivered as downloaded
+        ydl_opts['format'] = PROGRESSIVE_FORMATS[download_type]
+        ydl_opts['nopart'] = True
+        ydl_opts['fixup'] = 'never'  # Fixups rewrite the file after it was (partly) streamed
+        ydl_opts['postprocessors'] = []
+        ydl_opts.pop('merge_output_format', None)
+    return ydl_opts
+
+
+def check_cancelled(download_id):
+    """Abort the running yt-dlp instance if the job was cancelled"""
+    import yt_dlp
+
+    if scheduler.is_cancelled(download_id):
+        raise yt_dlp.utils.DownloadCancelled("Download cancelled by user")
+
+
+def postprocessor_hook(d, download_id):
+    """Postprocessor hook for yt-dlp"""
+    key = (download_id, threading.get_ident(), d.get('postprocessor'))
+    if d['status'] == 'started':
+        _postprocessor_started[key] = time.monotonic()
+    elif d['status'] == 'finished' and key in _postprocessor_started:
+        elapsed = time.monotonic() - _postprocessor_started.pop(key)
+        POSTPROCESSOR_SECONDS.observe(elapsed, postprocessor=d.get('postprocessor'))
+        PHASE_SECONDS.observe(elapsed, phase='postprocessing')
+        filename = (d.get('info_dict') or {}).get('filepath')
+        record_phase(download_id, 'merge' if d.get('postprocessor') == 'Merger' else 'postprocessing',
+                     time.time() - elapsed, postprocessor=d.get('postprocessor'),
+                     file=os.path.basename(filename) if filename else None)
+    check_cancelled(download_id)
+
+
+def record_hook_metrics(d, download_id):
+    """Byte and download-time metrics from a progress hook call"""
+    key = (download_id, d.get('filename'))
+    downloaded = d.get('downloaded_bytes') or 0
+    with _hook_bytes_lock:
+        previous = _hook_bytes.get(key, 0)
+        if d['status'] == 'downloading':
+            _hook_bytes[key] = downloaded
+        else:
+            _hook_bytes.pop(key, None)
+    progress = download_status.get(download_id)
+    if downloaded > previous and progress is not None:
+        DOWNLOADED_BYTES.inc(downloaded - previous, type=progress.download_type)
+    if d['status'] == 'finished' and d.get('elapsed') is not None:
+        PHASE_SECONDS.observe(d['elapsed'], phase='download')
+        size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+        record_phase(download_id, 'download', time.time() - d['elapsed'], bytes=size,
+                     file=os.path.basename(d.get('filename') or '') or None)
+        if progress is not None and progress.transfer and size and d['elapsed'] > 0:
+            progress.transfer['bytes'] = progress.transfer.get('bytes', 0) + size
+            progress.transfer['seconds'] = progress.transfer.get('seconds', 0) + d['elapsed']
+            if is_fragmented(d.get('info_dict')):
+                # Under the host the setting was chosen for, which for playlists may not be the job's
+                fragment_tuner.record(progress.transfer.get('host') or progress.host,
+                                      progress.transfer.get('concurrent_fragment_downloads'), size / d['elapsed'])
+
+
+def forget_hook_state(download_id):
+    """Drop hook bookkeeping left by a job's downloads that never reported 'finished'"""
+    with _hook_bytes_lock:
+        for key in [key for key in _hook_bytes if key[0] == download_id]:
+            del _hook_bytes[key]
+    for key in [key for key in list(_postprocessor_started) if key[0] == download_id]:
+        _postprocessor_started.pop(key, None)
+
+
+def mark_failed(download_id, error):
+    """Record why a job stopped"""
+    if scheduler.is_cancelled(download_id):
+        download_status[download_id].status = "cancelled"
+    else:
+        ERRORS.inc(exception=type(error).__name__)
+        download_status[download_id].status = "error"
+        download_status[download_id].error = str(error)
+
+
+def mark_cache_hit(download_id, file_path):
+    """Progress for a single-file job served from the media cache"""
+    download_status[download_id].filename = os.path.basename(file_path)
+    download_status[download_id].downloaded_files = 1
+    download_status[download_id].progress = 100
+    notify_change(download_id)
+
+
+def run_postprocessors(download_id, file_path, postprocessors, should_stop=None):
+    """Apply postprocessors with the transcoder, recording whether the file was remuxed or transcoded"""
+    import yt_dlp
+
+    methods = []
+    try:
+        for pp in postprocessors:
+            started = time.monotonic()
+            file_path, method = convert(file_path, pp, should_stop)
+            elapsed = time.monotonic() - started
+            POSTPROCESSOR_SECONDS.observe(elapsed, postprocessor=pp['key'])
+            PHASE_SECONDS.observe(elapsed, phase='postprocessing')
+            record_phase(download_id, 'postprocessing', time.time() - elapsed, postprocessor=pp['key'],
+                         method=method, file=os.path.basename(file_path))
+            CONVERSIONS.inc(postprocessor=pp['key'], method=method)
+            methods.append(method)
+    except TranscodeCancelled as e:
+        raise yt_dlp.utils.DownloadCancelled(str(e))
+
+    progress = download_status.get(download_id)
+    if progress is not None:
+        # Most expensive step the file went through
+        for method in (METHOD_TRANSCODE, METHOD_REMUX, METHOD_NONE):
+            if method in methods:
+                progress.conversions[os.path.basename(file_path)] = method
+                break
+    return file_path
+
+
+def progress_hook(d, download_id):
+    """Progress hook for yt-dlp"""
+    check_cancelled(download_id)
+    record_hook_metrics(d, download_id)
+    if download_id in download_status:
+        if d['status'] == 'downloading':
+            if 'total_bytes' in d and d['total_bytes']:
+                download_status[download_id].progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
+            download_status[download_id].status = "downloading"
+            download_status[download_id].filename = os.path.basename(d.get('filename', ''))
+            download_status[download_id].file_path = d.get('filename')
+            download_status[download_id].total_bytes = d.get('total_bytes')
+        elif d['status'] == 'finished':
+            download_status[download_id].downloaded_files += 1
+            download_status[download_id].filename = os.path.basename(d.get('filename', ''))
+            # Update progress based on files downloaded
+            if download_status[download_id].total_files > 0:
+                download_status[download_id].progress = (download_status[download_id].downloaded_files /
+                                                         download_status[download_id].total_files) * 100
+        notify_change(download_id)
+
+
+class PlaylistTracker:
+    """Aggregates progress of playlist entries that download concurrently"""
+
+    def __init__(self, download_id):
+        self.download_id = download_id
+        self.lock = threading.Lock()
+        self.fractions = {}  # entry index -> fraction of its bytes downloaded
+
+    def _update_progress(self):
+        progress = download_status[self.download_id]
+        if progress.total_files > 0:
+            done = progress.downloaded_files + sum(self.fractions.values())
+            progress.progress = min(done / progress.total_files, 1) * 100
+
+    def hook(self, d, index):
+        """Progress hook for a single playlist entry"""
+        check_cancelled(self.download_id)
+        record_hook_metrics(d, self.download_id)
+        if self.download_id not in download_status or d['status'] != 'downloading':
+            return
+        with self.lock:
+            if d.get('total_bytes'):
+                self.fractions[index] = d['downloaded_bytes'] / d['total_bytes']
+            download_status[self.download_id].status = "downloading"
+            download_status[self.download_id].filename = os.path.basename(d.get('filename', ''))
+            self._update_progress()
+        notify_change(self.download_id)
+
+    def entry_finished(self, index):
+        # Counted per entry rather than per 'finished' event, so merged formats
+        # and entries completing out of order are only counted once
+        with self.lock:
+            self.fractions.pop(index, None)
+            download_status[self.download_id].downloaded_files += 1
+            self._update_progress()
+        notify_change(self.download_id)
+
+    def stage(self, name, delta):
+        """Move an entry into (+1) or out of (-1) the 'active_downloads' or 'active_conversions' stage"""
+        progress = download_status.get(self.download_id)
+        if progress is None:
+            return
+        with self.lock:
+            setattr(progress, name, getattr(progress, name) + delta)
+        notify_change(self.download_id)
+
+
+def record_ydl_setup(seconds, reused, download_id=None):
+    YDL_SETUP_SECONDS.observe(seconds, instance='reused' if reused else 'new')
+    PHASE_SECONDS.observe(seconds, phase='setup')
+    if download_id is not None:
+        record_phase(download_id, 'setup', time.time() - seconds, reused=reused)
+
+
+def warm_ydl_pool():
+    """Create the yt-dlp instances the first job of each type asks for, so it skips the setup"""
+    started = time.monotonic()
+    profiles = [FLAT_EXTRACT_OPTIONS]
+    for download_type in OPTION_PROFILES:
+        ydl_opts = ydl_options(download_type, None)
+        if download_type == 'single_audio':
+            ydl_opts['postprocessors'] = []  # Converted by the transcoder instead
+        elif download_type.startswith('playlist_'):
+            # As download_playlist_entries sets them up for each entry
+            ydl_opts['noplaylist'] = True
+            ydl_opts.pop('ignoreerrors', None)
+            if all(pp['key'] in SUPPORTED_POSTPROCESSORS for pp in ydl_opts.get('postprocessors') or []):
+                ydl_opts['postprocessors'] = []
+        profiles.append(ydl_opts)
+    for ydl_opts in profiles:
+        try:
+            ydl_pool.warm(ydl_opts)
+        except Exception as e:
+            print(f"Could not prepare a yt-dlp instance: {e}")
+    return time.monotonic() - started
+
+
+def wait_for_host(host, download_id=None):
+    """Block until host_throttle allows another request to host"""
+    import yt_dlp
+
+    waited = host_throttle.acquire(host, lambda: download_id is not None and scheduler.is_cancelled(download_id))
+    if waited is None:
+        raise yt_dlp.utils.DownloadCancelled("Download cancelled by user")
+    THROTTLE_WAIT.observe(waited)
+    if waited > 0.001 and download_id is not None:
+        record_phase(download_id, 'throttle', time.time() - waited, host=host)
+
+
+def report_host_error(host, error):
+    """Slow down requests to host if error says it is throttling us"""
+    if is_throttled(error):
+        THROTTLE_BACKOFFS.inc()
+        host_throttle.throttled(host)
+
+
+def transfer_status(progress):
+    """Download settings a job uses and the throughput it achieved"""
+    transfer = progress.transfer
+    host = transfer.get('host') or progress.host
+    return {
+        'concurrent_fragment_downloads': transfer.get('concurrent_fragment_downloads'),
+        'http_chunk_size': transfer.get('http_chunk_size'),
+        'buffersize': transfer.get('buffersize'),
+        'bytes_per_second': round(transfer['bytes'] / transfer['seconds']) if transfer.get('seconds') else None,
+        # Throughput measured per fragment concurrency for this host, across jobs
+        'fragment_tuning': fragment_tuner.state(host) if host else None,
+    }
+
+
+def throttle_status(progress):
+    """Request rate of a job's host and the job's share of the bandwidth limit"""
+    return dict(host_throttle.state(progress.host), bandwidth_limit=bandwidth.job_limit(progress.download_id))
+
+
+def extract_flat(url, items=None):
+    """Flat extraction of url; with a yt-dlp playlist_items spec, only those entries are fetched"""
+    host = url_host(url)
+    wait_for_host(host)
+    started = time.monotonic()
+    options = dict(FLAT_EXTRACT_OPTIONS, playlist_items=items) if items else FLAT_EXTRACT_OPTIONS
+    with ydl_pool.acquire(options, record_ydl_setup) as ydl:
+        try:
+            info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            report_host_error(host, e)
+            raise
+    host_throttle.success(host)
+    PHASE_SECONDS.observe(time.monotonic() - started, phase='extraction')
+    return info
+
+
+def extract_playlist(url, items=None):
+    """Expand a playlist, returning its directory name and flat entries (only those picked by items)"""
+    import yt_dlp
+
+    info = extract_flat(url, items)
+    if 'entries' not in info:
+        # Single video, named like yt-dlp names a missing playlist title
+        return 'NA', [{'url': url, 'ie_key': info.get('extractor_key'), 'id': info.get('id')}]
+
+    playlist_dir = yt_dlp.utils.sanitize_filename(info.get('title') or info.get('id') or 'playlist')
+    entries = [entry for entry in info['entries'] if entry]
+    return playlist_dir, entries
+
+
+def check_items(items):
+    """items if it is a valid playlist_items spec. Raises ValueError."""
+    from yt_dlp.utils import PlaylistEntries
+
+    list(PlaylistEntries.parse_playlist_items(items))
+    return items
+
+
+def select_items(entries, items):
+    """Entries picked by a playlist_items spec such as '1-10,15' or '-5:', in playlist order"""
+    from yt_dlp.utils import PlaylistEntries
+
+    # Only reads the spec from params; lazy_playlist skips yt-dlp's filters, which need a real instance
+    picker = PlaylistEntries(types.SimpleNamespace(params={'playlist_items': items, 'lazy_playlist': True}),
+                             {'entries': entries})
+    return [entry for _, entry in sorted(dict(picker.get_requested_items()).items())]
+
+
+def get_playlist_entries(url, items=None):
+    """Cached playlist expansion, so repeat submissions skip extraction.
+
+    A selection of items is taken from the cached expansion when there is one,
+    and otherwise extracted on its own so the rest of the playlist is not fetched.
+    """
+    if items:
+        cached = extraction_cache.get(url)
+        if cached is None:
+            return extract_playlist(url, items)
+        return cached[0], select_items(cached[1], items)
+    playlist_dir, entries = extraction_cache.get_or_extract(url, extract_playlist)
+    return playlist_dir, list(entries)
+
+
+def entry_summary(index, entry):
+    from yt_dlp.utils import unsmuggle_url
+
+    return {
+        'index': index,
+        'id': entry_id(entry),  # What /download takes as entry_ids
+        'title': entry.get('title'),
+        'duration': entry.get('duration'),
+        'url': unsmuggle_url(entry.get('webpage_url') or entry.get('url') or '')[0],
+    }
+
+
+def playlist_page(url, cursor=0, limit=50):
+    """Flat entries cursor+1 to cursor+limit of a playlist, with the cursor of the next page.
+
+    Only the requested page is extracted, unless the whole playlist is cached.
+    'total' is None when the site does not say how long the playlist is.
+    """
+    cached = extraction_cache.get(url)
+    if cached is not None:
+        title, entries = cached
+        page = list(enumerate(entries[cursor:cursor + limit + 1], cursor + 1))
+        total = len(entries)
+    else:
+        # One extra entry tells whether there is another page
+        info = extract_flat(url, f'{cursor + 1}:{cursor + limit + 1}')
+        if 'entries' not in info:
+            return {'title': info.get('title'), 'total': 1, 'next_cursor': None,
+                    'entries': [entry_summary(1, info)] if cursor == 0 else []}
+        title, total = info.get('title') or info.get('id'), info.get('playlist_count')
+        page = [(entry.get('playlist_index') or cursor + i, entry)
+                for i, entry in enumerate(info['entries'], 1) if entry]
+    return {
+        'title': title,
+        'total': total,
+        'next_cursor': cursor + limit if len(page) > limit else None,
+        'entries': [entry_summary(index, entry) for index, entry in page[:limit]],
+    }
+
+
+def materialize_cached(key, output_dir, download_id=None):
+    """media_cache.materialize, recording a hit on the job's timeline"""
+    started = time.time()
+    cached_path = media_cache.materialize(key, output_dir)
+    if cached_path:
+        record_phase(download_id, 'cache_hit', started, file=os.path.basename(cached_path),
+                     bytes=os.path.getsize(cached_path))
+    return cached_path
+
+
+def download_media(url, ydl_opts, output_dir, ie_key=None, video_id=None, cache_opts=None, store=True,
+                   download_id=None):
+    """Download one video with ydl_opts into output_dir, going through the media cache.
+
+    The cache key is built from cache_opts (default: ydl_opts). With store=False
+    the caller stores the file itself, e.g. once it has been converted. Requests
+    are paced by host_throttle and the download shares download_id's bandwidth.
+    Returns (file path or None, whether it was a cache hit, cache key or None).
+    """
+    import yt_dlp
+
+    options = {name: (cache_opts or ydl_opts).get(name) for name in MEDIA_CACHE_KEY_OPTIONS}
+    if ie_key and video_id:
+        # Known video (e.g. a flat playlist entry): a hit needs no extraction at all
+        key = media_cache.make_key(f'{ie_key}:{video_id}', options)
+        cached_path = materialize_cached(key, output_dir, download_id)
+        if cached_path:
+            return cached_path, True, key
+
+    host = url_host(url)
+    wait_for_host(host, download_id)
+    with ydl_pool.acquire(ydl_opts, lambda seconds, reused: record_ydl_setup(seconds, reused, download_id)) as ydl:
+        fragments = ydl.params['concurrent_fragment_downloads'] = fragment_tuner.choose(host)
+        progress = download_status.get(download_id)
+        if progress is not None:
+            progress.transfer.update(host=host, concurrent_fragment_downloads=fragments,
+                                     http_chunk_size=ydl.params.get('http_chunk_size'),
+                                     buffersize=ydl.params.get('buffersize'))
+        bandwidth.attach(download_id, ydl.params)
+        try:
+            started = time.monotonic()
+            with timed_phase(download_id, 'extraction', url=url):
+                info = ydl.extract_info(url, ie_key=ie_key, download=False, process=False)
+            PHASE_SECONDS.observe(time.monotonic() - started, phase='extraction')
+            if info is None:
+                return None, False, None  # Failed and skipped because of ignoreerrors
+            if info.get('_type', 'video') != 'video' or not info.get('id'):
+                # Not a single video, nothing sensible to cache
+                ydl.process_ie_result(info, download=True)
+                return None, False, None
+
+            key = media_cache.make_key(f"{info['extractor_key']}:{info['id']}", options)
+            cached_path = materialize_cached(key, output_dir, download_id)
+            if cached_path:
+                return cached_path, True, key
+
+            # Reuse the extraction we already did instead of starting over from the URL
+            try:
+                result = ydl.process_ie_result(info, download=True)
+            except yt_dlp.utils.DownloadCancelled:
+                raise
+            except Exception:
+                fragment_tuner.failed(host, fragments)
+                raise
+        except Exception as e:
+            report_host_error(host, e)
+            raise
+        finally:
+            bandwidth.detach(download_id, ydl.params)
+    host_throttle.success(host)
+
+    downloads = (result or {}).get('requested_downloads') or []
+    file_path = downloads[-1].get('filepath') if downloads else None
+    if file_path and os.path.isfile(file_path):
+        if store:
+            media_cache.store(key, file_path)
+        return file_path, False, key
+    return None, False, None
+
+
+def download_playlist_entries(url, download_id, ydl_opts, concurrency, ignore_errors=False, archive=None,
+                              items=None, entry_ids=None):
+    """Download every playlist entry, running up to `concurrency` at a time.
+
+    With an archive, entries it already lists are skipped. Returns the archive IDs
+    of the entries that finished, for the caller to archive once the job completes.
+    items (a playlist_items spec) or entry_ids limit the download to those entries.
+    """
+    import yt_dlp
+
+    with timed_phase(download_id, 'extraction', url=url) as phase:
+        playlist_dir, entries = get_playlist_entries(url, items)
+        phase['entries'] = len(entries)
+    if entry_ids:
+        wanted = set(entry_ids)
+        entries = [entry for entry in entries if entry_id(entry) in wanted]
+    if archive is not None:
+        done = archive.load()
+        entries = [entry for entry in entries if entry_archive_id(entry) not in done]
+    download_status[download_id].total_files = len(entries)
+
+    tracker = PlaylistTracker(download_id)
+
+    output_dir = f'{DOWNLOAD_DIR}/{download_id}/{playlist_dir}'
+
+    # ffmpeg postprocessing moves to the transcode pool, so the download slot is
+    # free for the next entry while this one converts
+    postprocessors = ydl_opts.get('postprocessors') or []
+    pipelined = bool(postprocessors) and all(pp['key'] in SUPPORTED_POSTPROCESSORS for pp in postprocessors)
+    conversions = []
+    finished = []
+    stopped = threading.Event()
+
+    def should_stop():
+        return stopped.is_set() or scheduler.is_cancelled(download_id)
+
+    def sleep_unless_stopped(seconds):
+        deadline = time.monotonic() + seconds
+        while not should_stop():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            stopped.wait(min(remaining, 0.5))
+        raise yt_dlp.utils.DownloadCancelled("Download cancelled")
+
+    def finish_entry(index, entry, file_path, cache_hit):
+        if cache_hit:
+            download_status[download_id].filename = os.path.basename(file_path)
+        finished.append(entry_archive_id(entry))
+        tracker.entry_finished(index)
+
+    def convert_entry(index, entry, file_path, key):
+        if should_stop():
+            raise yt_dlp.utils.DownloadCancelled("Download cancelled")
+        tracker.stage('active_conversions', 1)
+        try:
+            file_path = run_postprocessors(download_id, file_path, postprocessors, should_stop)
+        finally:
+            tracker.stage('active_conversions', -1)
+        media_cache.store(key, file_path)
+        finish_entry(index, entry, file_path, False)
+
+    def download_entry(index, entry):
+        check_cancelled(download_id)
+        entry_opts = dict(ydl_opts)
+        # Entries are downloaded one by one, so escape template characters in the playlist title
+        entry_opts['outtmpl'] = f"{output_dir.replace('%', '%%')}/%(title)s.%(ext)s"
+        entry_opts['noplaylist'] = True
+        # Let failures raise, so this entry alone is retried (the job may still skip it)
+        entry_opts.pop('ignoreerrors', None)
+        entry_opts['progress_hooks'] = [lambda d: tracker.hook(d, index)]
+        if pipelined:
+            entry_opts['postprocessors'] = []
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        anonymous_opts = {name: value for name, value in entry_opts.items()
+                          if name not in ('cookiesfrombrowser', 'cookiefile')}
+        has_cookies = cookie_source(entry_opts) is not None
+        # Cookies known not to load right now are not worth an attempt
+        use_cookies = has_cookies and cookie_jars.available(entry_opts)
+
+        tracker.stage('active_downloads', 1)
+        try:
+            for attempt in range(1, ENTRY_ATTEMPTS + 1):
+                try:
+                    file_path, cache_hit, key = download_media(
+                        entry_url, entry_opts if use_cookies else anonymous_opts, output_dir,
+                        entry.get('ie_key'), entry.get('id'), ydl_opts, store=not pipelined,
+                        download_id=download_id)
+                    break
+                except yt_dlp.utils.DownloadCancelled:
+                    raise
+                except Exception as e:
+                    if attempt >= ENTRY_ATTEMPTS:
+                        raise
+                    ENTRY_RETRIES.inc(cookies=str(use_cookies).lower())
+                    if use_cookies:
+                        cookie_jars.refresh(entry_opts)  # They may have expired
+                    if has_cookies:
+                        # Switch auth mode for this entry only; other entries keep theirs
+                        use_cookies = not use_cookies and cookie_jars.available(entry_opts)
+                    delay = ENTRY_RETRY_DELAY * 2 ** (attempt - 1)
+                    print(f"Playlist entry {index + 1} failed ({e}), retrying "
+                          f"{'with' if use_cookies else 'without'} cookies in {delay:g}s")
+                    with timed_phase(download_id, 'retry_wait', entry=index + 1, attempt=attempt):
+                        sleep_unless_stopped(delay)
+        finally:
+            tracker.stage('active_downloads', -1)
+
+        if pipelined and not cache_hit and file_path is not None:
+            # Blocks while the transcode backlog is full, holding back further downloads
+            conversions.append(transcode_pool.submit(job_profiler.wrap(download_id, convert_entry),
+                                                     index, entry, file_path, key))
+            return
+        finish_entry(index, entry, file_path, cache_hit)
+
+    def collect(future):
+        try:
+            future.result()
+        except yt_dlp.utils.DownloadCancelled:
+            raise
+        except Exception as e:
+            if not ignore_errors:
+                raise
+            ERRORS.inc(exception=type(e).__name__)
+            print(f"Skipping failed playlist entry: {e}")
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency),
+                                  thread_name_prefix=f"playlist-{download_id[:8]}")
+    download_entry = job_profiler.wrap(download_id, download_entry)
+    # This thread only waits from here on, so let an entry or conversion thread be profiled
+    with job_profiler.released(download_id):
+        futures = [executor.submit(download_entry, index, entry) for index, entry in enumerate(entries)]
+        try:
+            for future in as_completed(futures):
+                collect(future)
+            for future in as_completed(conversions):
+                collect(future)
+        except BaseException:
+            stopped.set()
+            raise
+        finally:
+            # Drop entries that have not started yet when the job fails or is cancelled
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for future in conversions:
+                future.cancel()
+            wait_futures(conversions)
+    return finished
+
+
+def download_single_video(url, download_id, progressive=False):
+    try:
+        download_status[download_id].total_files = 1
+
+        output_dir = f'{DOWNLOAD_DIR}/{download_id}'
+        ydl_opts = ydl_options('single_video', download_id, progressive)
+        ydl_opts['outtmpl'] = f'{output_dir}/%(title)s.%(ext)s'
+        ydl_opts['progress_hooks'] = [lambda d: progress_hook(d, download_id)]
+
+        file_path, cache_hit, _ = download_media(url, ydl_opts, output_dir, download_id=download_id)
+        if cache_hit:
+            mark_cache_hit(download_id, file_path)
+
+        download_status[download_id].status = "completed"
+
+    except Exception as e:
+        mark_failed(download_id, e)
+
+
+def download_single_audio(url, download_id, progressive=False):
+    try:
+        download_status[download_id].total_files = 1
+
+        output_dir = f'{DOWNLOAD_DIR}/{download_id}'
+        ydl_opts = ydl_options('single_audio', download_id, progressive)
+        ydl_opts['outtmpl'] = f'{output_dir}/%(title)s.%(ext)s'
+        ydl_opts['progress_hooks'] = [lambda d: progress_hook(d, download_id)]
+
+        # Download as is, then let the transcoder decide between a remux and a re-encode
+        file_path, cache_hit, key = download_media(url, dict(ydl_opts, postprocessors=[]), output_dir,
+                                                   cache_opts=ydl_opts, store=False, download_id=download_id)
+        if cache_hit:
+            mark_cache_hit(download_id, file_path)
+        elif file_path is not None:
+            file_path = run_postprocessors(download_id, file_path, ydl_opts['postprocessors'],
+                                           lambda: scheduler.is_cancelled(download_id))
+            media_cache.store(key, file_path)
+            download_status[download_id].filename = os.path.basename(file_path)
+
+        download_status[download_id].status = "completed"
+
+    except Exception as e:
+        mark_failed(download_id, e)
+
+
+def download_playlist_videos(url, download_id, concurrency=PLAYLIST_CONCURRENCY, sync=False, items=None,
+                            entry_ids=None):
+    try:
+        ydl_opts = ydl_options('playlist_videos', download_id)
+        archive = DownloadArchive(ARCHIVE_DIR, url, 'playlist_videos') if sync else None
+        finished = download_playlist_entries(url, download_id, ydl_opts, concurrency, archive=archive,
+                                             items=items, entry_ids=entry_ids)
+        if archive is not None:
+            # Only now can the client fetch them; a failed or cancelled sync delivers nothing
+            archive.add_many(finished)
+
+        download_status[download_id].status = "completed"
+
+    except Exception as e:
+        mark_failed(download_id, e)
+
+
+def download_playlist_audio(url, download_id, concurrency=PLAYLIST_CONCURRENCY, sync=False, items=None,
+                           entry_ids=None):
+    try:
+        ydl_opts = ydl_options('playlist_audio', download_id)
+        archive = DownloadArchive(ARCHIVE_DIR, url, 'playlist_audio') if sync else None
+        finished = download_playlist_entries(url, download_id, ydl_opts, concurrency, ignore_errors=True,
+                                             archive=archive, items=items, entry_ids=entry_ids)
+        if archive is not None:
+            # Only now can the client fetch them; a failed or cancelled sync delivers nothing
+            archive.add_many(finished)
+
+        download_status[download_id].status = "completed"
+
+    except Exception as e:
+        mark_failed(download_id, e)
+
+
+def run_download(download_type, url, download_id, options):
+    """Entry point for scheduler workers"""
+    progress = download_status.get(download_id)
+    if progress is None:
+        return  # Cleaned up while still waiting in the queue
+    QUEUE_WAIT.observe(time.time() - progress.created_at, type=download_type)
+    progress.timeline = JobTimeline(download_id, download_type, trace_log, TIMELINE_MAX_EVENTS)
+    progress.timeline.record('queue', progress.created_at)
+    progress.status = "starting"
+    progress.host = url_host(url)
+    notify_change(download_id, force=True)
+    started = time.monotonic()
+    run_started = time.time()
+    job_profiler.start(download_id)
+    try:
+        with job_profiler.thread(download_id):
+            DOWNLOAD_FUNCTIONS[download_type](url, download_id, **options)
+    finally:
+        forget_inflight(download_id)
+        forget_hook_state(download_id)
+        progress.timeline.profile = job_profiler.finish(download_id)
+        progress.timeline.record('run', run_started, status=progress.status, error=progress.error)
+        JOB_DURATION.observe(time.monotonic() - started, type=download_type)
+        JOBS_FINISHED.inc(type=download_type, status=progress.status)
+        if download_id in download_status:  # Not removed by /cleanup mid-download
+            progress.finished_at = time.time()
+        notify_change(download_id, force=True)
+
+
+DOWNLOAD_FUNCTIONS = {
+    'single_video': download_single_video,
+    'single_audio': download_single_audio,
+    'playlist_videos': download_playlist_videos,
+    'playlist_audio': download_playlist_audio,
+}
+
+
+def unique_urls(urls):
+    """URLs in their original order, without blanks or duplicates (compared after normalization)"""
+    seen = set()
+    result = []
+    for url in urls:
+        url = url.strip()
+        key = normalize_url(url)
+        if url and key not in seen:
+            seen.add(key)
+            result.append(url)
+    return result
+
+
+def read_url_list(lines):
+    """URLs from a text file or stdin: one per line, blank lines and lines starting with # ignored"""
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+def create_job(download_type, group_id=None):
+    """Register a new queued job and create its session directory"""
+    progress = DownloadProgress(str(uuid.uuid4()), download_type)
+    progress.group_id = group_id
+    download_status[progress.download_id] = progress
+    os.makedirs(os.path.join(DOWNLOAD_DIR, progress.download_id), exist_ok=True)
+    return progress
+
+
+def discard_job(download_id):
+    """Forget a job that never made it into the queue"""
+    download_status.pop(download_id)
+    shutil.rmtree(os.path.join(DOWNLOAD_DIR, download_id), ignore_errors=True)
+
+
+def inflight_key(download_type, url, options):
+    return (download_type, normalize_url(url), json.dumps(options, sort_keys=True))
+
+
+def submit_job(download_type, url, options, on_create=None):
+    """Queue a download, or attach to an identical job that is still queued or running.
+
+    Returns (progress, ID of the shared job or None). on_create(progress) runs
+    before the job can start, e.g. to store it. Raises QueueFull.
+    """
+    key = inflight_key(download_type, url, options)
+    with _inflight_lock:
+        owner = download_status.get(_inflight.get(key))
+        if owner is not None and owner.status not in TERMINAL_STATUSES and owner.subscribers:
+            progress = DownloadProgress(str(uuid.uuid4()), download_type)
+            progress.alias_of = owner.download_id
+            for name in SHARED_FIELDS:
+                setattr(progress, name, copy.copy(getattr(owner, name)))
+            download_status[progress.download_id] = progress
+            owner.subscribers.add(progress.download_id)
+            if on_create is not None:
+                on_create(progress)
+            JOBS_COALESCED.inc(type=download_type)
+            return progress, owner.download_id
+
+        progress = create_job(download_type)
+        progress.progressive = options.get('progressive', False)
+        if on_create is not None:
+            on_create(progress)
+        try:
+            scheduler.submit(progress.download_id, run_download, download_type, url, progress.download_id, options)
+        except QueueFull:
+            discard_job(progress.download_id)
+            raise
+        _inflight[key] = progress.download_id
+        return progress, None
+
+
+def forget_inflight(download_id):
+    """Stop attaching new submissions to a job"""
+    with _inflight_lock:
+        for key in [key for key, owner_id in _inflight.items() if owner_id == download_id]:
+            del _inflight[key]
+
+
+def has_followers(progress):
+    """Whether jobs coalesced into this one still follow it"""
+    subscribers = progress.subscribers
+    return len(subscribers) - (progress.download_id in subscribers) > 0
+
+
+def detached_view(progress):
+    """What the submitter of a detached job sees: the job as it was when they left, cancelled"""
+    view = DownloadProgress(progress.download_id, progress.download_type)
+    for name in SHARED_FIELDS:
+        setattr(view, name, copy.copy(getattr(progress, name)))
+    view.status = 'cancelled'
+    view.active_downloads = view.active_conversions = 0
+    view.finished_at = progress.detached_at
+    return view
+
+
+def detach_job(progress, how):
+    """Let a job's own submitter leave while the download continues for the jobs coalesced into it"""
+    if progress.detached is None:
+        progress.detached_at = time.time()
+    progress.detached = how
+    notify_change(progress.download_id, force=True)
+
+
+def share_progress(owner, force=False):
+    """Copy a job's state to the jobs coalesced into it"""
+    with _inflight_lock:
+        followers = [download_id for download_id in owner.subscribers if download_id != owner.download_id]
+    for download_id in followers:
+        progress = download_status.get(download_id)
+        if progress is None or progress.alias_of != owner.download_id:
+            continue
+        for name in SHARED_FIELDS:
+            setattr(progress, name, copy.copy(getattr(owner, name)))
+        progress_broker.publish(download_id, force=force)
+        mark_changed(download_id)
+
+
+def files_owner(progress):
+    """ID of the job whose session directory holds a job's files"""
+    return progress.alias_of or progress.download_id
+
+
+def release_job(download_id):
+    """Drop one submitter's claim on a job's files.
+
+    Returns the ID of the job whose files nobody needs any more, or None while
+    other submitters still share them.
+    """
+    progress = download_status.get(download_id)
+    owner_id = files_owner(progress) if progress is not None else download_id
+    owner = download_status.get(owner_id)
+    if owner is None:
+        return owner_id
+    with _inflight_lock:
+        owner.subscribers.discard(download_id)
+        return None if owner.subscribers else owner_id
+
+
+def create_batch(urls, download_type):
+    """Job records for a batch: the group that aggregates progress, and one (job, URL) per URL"""
+    group = DownloadProgress(str(uuid.uuid4()), 'batch')
+    download_status[group.download_id] = group
+    members = [(create_job(download_type, group.download_id), url) for url in urls]
+    group.members = tuple(progress.download_id for progress, _ in members)
+    group.total_files = len(members)
+    return group, members
+
+
+def submit_batch(group, members, options, concurrency):
+    """Queue every job of a batch, at most `concurrency` of them running at once. Raises QueueFull."""
+    scheduler.submit_group(
+        [(progress.download_id, run_download, progress.download_type, url, progress.download_id, options)
+         for progress, url in members],
+        group=group.download_id, limit=concurrency,
+    )
+
+
+def refresh_batch(group_id, lookup=None):
+    """Recompute a batch's aggregate status and progress from its jobs.
+
+    `lookup` finds member jobs (default: this process's registry).
+    """
+    group = download_status.get(group_id)
+    if group is None or not group.members:
+        return
+    members = [(lookup or download_status.get)(member_id) for member_id in group.members]
+    # Members that were cleaned up count as finished
+    statuses = [progress.status if progress is not None else 'cancelled' for progress in members]
+    done = sum(100 if progress is None or progress.status in TERMINAL_STATUSES else progress.progress
+               for progress in members)
+    group.progress = done / len(members)
+    group.downloaded_files = statuses.count('completed')
+
+    if not all(status in TERMINAL_STATUSES for status in statuses):
+        group.status = 'queued' if all(status == 'queued' for status in statuses) else 'downloading'
+    elif group.finished_at is None:
+        failed = statuses.count('error')
+        if group.downloaded_files:
+            group.status = 'completed'
+            group.error = f'{failed} of {len(members)} downloads failed' if failed else None
+        else:
+            group.status = 'error' if failed else 'cancelled'
+            group.error = 'All downloads failed' if failed else None
+        group.finished_at = time.time()
+    notify_change(group_id, force=group.finished_at is not None)
+
+
+def cancel_job(download_id):
+    """Cancel a job of this process (every job, for a batch). Returns its progress or None.
+
+    A shared download keeps running until none of its submitters want it.
+    """
+    progress = download_status.get(download_id)
+    if progress is None or progress.detached == 'removed':
+        return None
+    if progress.detached is not None:
+        return detached_view(progress)
+    for member_id in progress.members:
+        cancel_job(member_id)
+    owner = download_status.get(files_owner(progress))
+    if owner is not None and progress.status not in TERMINAL_STATUSES:
+        with _inflight_lock:
+            owner.subscribers.discard(download_id)
+            shared = bool(owner.subscribers)
+        if progress.alias_of is not None:
+            progress.status = "cancelled"
+            progress.finished_at = time.time()
+            notify_change(download_id, force=True)
+        elif shared:
+            detach_job(progress, 'cancelled')
+            return detached_view(progress)
+        if shared:
+            return progress
+        download_id = owner.download_id
+    job = download_status.get(download_id)
+    if scheduler.cancel(download_id) and job.status == "queued":
+        # Never started, so nothing will report the cancellation for us
+        forget_inflight(download_id)
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        notify_change(download_id, force=True)
+    return progress
@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that never change what gets extracted
+IGNORED_PARAMS = {'si', 'feature', 'pp', 'fbclid', 'gclid'}
+
+
+def normalize_url(url):
+    """Canonical form of a URL so trivially different submissions share a cache key"""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in IGNORED_PARAMS and not key.startswith('utm_')
+    )
+    path = parts.path.rstrip('/') or '/'
+    return urlunsplit((parts.scheme.lower(), host, path, urlencode(query), ''))
+
+
+class ExtractionCache:
+    """Thread-safe LRU cache of extraction results with a time-to-live"""
+
+    def __init__(self, max_entries=256, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        key = normalize_url(url)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.time() - item[0] > self.ttl:
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, url, value):
+        key = normalize_url(url)
+        with self._lock:
+            self._items[key] = (time.time(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def get_or_extract(self, url, extract):
+        """Return the cached value for url, calling extract(url) on a miss"""
+        value = self.get(url)
+        if value is None:
+            value = extract(url)
+            self.put(url, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
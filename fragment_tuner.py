@@ -0,0 +1,73 @@
+import threading
+
+# yt-dlp protocols downloaded as many small fragments, where fragment concurrency matters
+FRAGMENTED_PROTOCOLS = ('m3u8_native', 'http_dash_segments', 'ism', 'f4m')
+
+
+def is_fragmented(info_dict):
+    protocol = (info_dict or {}).get('protocol') or ''
+    return any(name in protocol.split('+') for name in FRAGMENTED_PROTOCOLS)
+
+
+class FragmentTuner:
+    """Chooses concurrent_fragment_downloads per host from measured throughput.
+
+    Every host starts at `initial`. After each fragmented download the setting
+    doubles while the bigger value has not been tried yet or was at least
+    `min_gain` faster, and halves again once the extra workers stop paying
+    off. A failed download halves the setting and marks it as slow.
+    """
+
+    def __init__(self, initial=4, maximum=16, min_gain=0.1, smoothing=0.5):
+        self.initial = max(1, initial)
+        self.maximum = max(self.initial, maximum)
+        self.min_gain = min_gain
+        self.smoothing = smoothing
+        self._hosts = {}  # host -> {'current': setting, 'rates': {setting: bytes per second}}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        # Called with the lock held
+        return self._hosts.setdefault(host, {'current': self.initial, 'rates': {}})
+
+    def choose(self, host):
+        with self._lock:
+            return self._host(host)['current']
+
+    def _next(self, rates, setting):
+        lower = max(1, setting // 2)
+        higher = min(self.maximum, setting * 2)
+        if lower != setting and lower in rates and rates[lower] * (1 + self.min_gain) > rates[setting]:
+            return lower  # Fewer workers were about as fast
+        if higher != setting and (higher not in rates or rates[higher] > rates[setting] * (1 + self.min_gain)):
+            return higher
+        return setting
+
+    def record(self, host, setting, bytes_per_second):
+        """Throughput of a finished fragmented download that used `setting`"""
+        if not setting or bytes_per_second <= 0:
+            return
+        with self._lock:
+            state = self._host(host)
+            rates = state['rates']
+            previous = rates.get(setting)
+            rates[setting] = (bytes_per_second if previous is None
+                              else self.smoothing * bytes_per_second + (1 - self.smoothing) * previous)
+            if setting == state['current']:
+                state['current'] = self._next(rates, setting)
+
+    def failed(self, host, setting):
+        """A download with `setting` failed; back off"""
+        if not setting:
+            return
+        with self._lock:
+            state = self._host(host)
+            if setting in state['rates']:
+                state['rates'][setting] /= 2
+            state['current'] = min(state['current'], max(1, setting // 2))
+
+    def state(self, host):
+        with self._lock:
+            state = self._host(host)
+            return {'current': state['current'],
+                    'measured': {str(k): round(v) for k, v in sorted(state['rates'].items())}}
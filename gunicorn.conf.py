@@ -0,0 +1,11 @@
+# Progress is pushed over long-lived Server-Sent Events connections, which would
+# each pin a sync worker, so serve requests from a thread pool instead. The app
+# caps open streams at MAX_EVENT_STREAMS (default: half of the threads) so the
+# rest stay free; pages over the cap poll /status instead.
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:3000')
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+timeout = 120
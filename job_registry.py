@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+class JobRegistry:
+    """Thread-safe map of download ID -> progress record.
+
+    Finished jobs are kept for `ttl` seconds so clients can still fetch their
+    status and files, then handed out by expired() for the reaper to remove.
+    At most `max_jobs` records are kept; past that the oldest finished jobs
+    expire early.
+    """
+
+    def __init__(self, ttl=3600, max_jobs=1000):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, download_id):
+        with self._lock:
+            return download_id in self._jobs
+
+    def __getitem__(self, download_id):
+        with self._lock:
+            return self._jobs[download_id]
+
+    def __setitem__(self, download_id, progress):
+        with self._lock:
+            self._jobs[download_id] = progress
+
+    def __delitem__(self, download_id):
+        with self._lock:
+            del self._jobs[download_id]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def get(self, download_id, default=None):
+        with self._lock:
+            return self._jobs.get(download_id, default)
+
+    def pop(self, download_id, default=None):
+        with self._lock:
+            return self._jobs.pop(download_id, default)
+
+    def ids(self):
+        with self._lock:
+            return set(self._jobs)
+
+    def finished(self):
+        """(finished_at, download_id) of every finished job, oldest first"""
+        with self._lock:
+            return sorted((job.finished_at, download_id) for download_id, job in self._jobs.items()
+                          if job.finished_at is not None)
+
+    def expired(self, now=None):
+        """IDs of finished jobs that are past their TTL or over the record limit"""
+        now = time.time() if now is None else now
+        finished = self.finished()
+        over_limit = max(0, len(self) - self.max_jobs)
+        expired = []
+        for index, (finished_at, download_id) in enumerate(finished):
+            if index < over_limit or now - finished_at > self.ttl:
+                expired.append(download_id)
+        return expired
@@ -0,0 +1,187 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Columns mirrored from DownloadProgress
+PROGRESS_FIELDS = ('status', 'progress', 'filename', 'error', 'total_files', 'downloaded_files', 'finished_at')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    download_id TEXT PRIMARY KEY,
+    download_type TEXT NOT NULL,
+    url TEXT NOT NULL,
+    options TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    filename TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    total_files INTEGER NOT NULL DEFAULT 0,
+    downloaded_files INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    owner TEXT,
+    heartbeat REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, heartbeat);
+"""
+
+
+class MemoryJobStore:
+    """Keeps nothing: jobs live only in the owning process"""
+
+    shared = False
+
+    def create(self, job, url, options, owner):
+        pass
+
+    def update_many(self, jobs, owner):
+        return set()
+
+    def load(self, download_id):
+        return None
+
+    def ids(self):
+        return set()
+
+    def request_cancel(self, download_id):
+        return False
+
+    def cancel_requests(self, download_ids):
+        return set()
+
+    def delete(self, download_id):
+        pass
+
+    def delete_expired(self, ttl):
+        pass
+
+    def claim_interrupted(self, owner, stale_after, terminal_statuses):
+        return []
+
+
+class SQLiteJobStore:
+    """Job table shared by every worker process through one SQLite file in WAL mode.
+
+    Progress hooks never write here directly; the app flushes changed jobs in
+    one transaction per interval, so write volume does not grow with hook rate.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        # One connection per thread; reads run in autocommit mode
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def create(self, job, url, options, owner):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO jobs (download_id, download_type, url, options, status, created_at, owner, heartbeat)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.download_id, job.download_type, url, json.dumps(options), job.status,
+                 job.created_at, owner, time.time()),
+            )
+
+    def update_many(self, jobs, owner):
+        """Write progress for jobs owned by `owner`. Returns IDs whose rows are gone."""
+        now = time.time()
+        missing = set()
+        with self._transaction() as conn:
+            for job in jobs:
+                cursor = conn.execute(
+                    f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in PROGRESS_FIELDS)}, heartbeat = ?"
+                    ' WHERE download_id = ? AND owner = ?',
+                    [getattr(job, name) for name in PROGRESS_FIELDS] + [now, job.download_id, owner],
+                )
+                if cursor.rowcount == 0:
+                    missing.add(job.download_id)
+        return missing
+
+    def load(self, download_id):
+        row = self._conn().execute('SELECT * FROM jobs WHERE download_id = ?', (download_id,)).fetchone()
+        return dict(row) if row else None
+
+    def ids(self):
+        return {row[0] for row in self._conn().execute('SELECT download_id FROM jobs')}
+
+    def request_cancel(self, download_id):
+        with self._transaction() as conn:
+            return conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE download_id = ?',
+                                (download_id,)).rowcount > 0
+
+    def cancel_requests(self, download_ids):
+        """Subset of download_ids that another process asked to cancel"""
+        if not download_ids:
+            return set()
+        ids = list(download_ids)
+        rows = self._conn().execute(
+            f"SELECT download_id FROM jobs WHERE cancel_requested = 1"
+            f" AND download_id IN ({', '.join('?' * len(ids))})", ids,
+        )
+        return {row[0] for row in rows}
+
+    def delete(self, download_id):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE download_id = ?', (download_id,))
+
+    def delete_expired(self, ttl):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?',
+                         (time.time() - ttl,))
+
+    def claim_interrupted(self, owner, stale_after, terminal_statuses):
+        """Take over unfinished jobs whose owner stopped sending heartbeats"""
+        placeholders = ', '.join('?' * len(terminal_statuses))
+        claimed = []
+        with self._transaction() as conn:
+            rows = conn.execute(
+                f'SELECT * FROM jobs WHERE status NOT IN ({placeholders}) AND heartbeat < ?',
+                list(terminal_statuses) + [time.time() - stale_after],
+            ).fetchall()
+            for row in rows:
+                # Only one process wins the update when several recover at once
+                cursor = conn.execute(
+                    'UPDATE jobs SET owner = ?, heartbeat = ?, status = ? WHERE download_id = ? AND owner IS ?',
+                    (owner, time.time(), 'queued', row['download_id'], row['owner']),
+                )
+                if cursor.rowcount:
+                    claimed.append(dict(row))
+        return claimed
+
+
+class _Transaction:
+    """Wraps a connection in BEGIN IMMEDIATE ... COMMIT"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def open_job_store(kind, path):
+    if kind == 'sqlite':
+        return SQLiteJobStore(path)
+    if kind == 'memory':
+        return MemoryJobStore()
+    raise ValueError(f"Unknown job store {kind!r}, expected 'sqlite' or 'memory'")
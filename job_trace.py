@@ -0,0 +1,188 @@
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+
+
+class JobTimeline:
+    """Phases of one job (queueing, extraction, downloads, postprocessing, ...) with their times.
+
+    Events are kept in the order they ended, at most `max_events` of them;
+    the totals per phase always cover every event. Each event is also
+    written to `trace`, if given.
+    """
+
+    def __init__(self, download_id, download_type, trace=None, max_events=500):
+        self.download_id = download_id
+        self.download_type = download_type
+        self.trace = trace
+        self.max_events = max_events
+        self.profile = None  # Where this job's cProfile stats were saved, if it was sampled
+        self._events = []
+        self._totals = {}  # phase -> [count, seconds, bytes]
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def record(self, phase, started, ended=None, **fields):
+        """Add a phase that ran from `started` to `ended` (time.time() values; default: now)"""
+        ended = time.time() if ended is None else ended
+        event = {'phase': phase, 'start': round(started, 3), 'end': round(ended, 3),
+                 'seconds': round(ended - started, 4)}
+        event.update((name, value) for name, value in fields.items() if value is not None)
+        with self._lock:
+            totals = self._totals.setdefault(phase, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += ended - started
+            totals[2] += fields.get('bytes') or 0
+            if len(self._events) < self.max_events:
+                self._events.append(event)
+            else:
+                self._dropped += 1
+        if self.trace is not None:
+            self.trace.write(dict(event, job=self.download_id, type=self.download_type))
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'phases': {phase: {'count': count, 'seconds': round(seconds, 4), 'bytes': size}
+                           for phase, (count, seconds, size) in self._totals.items()},
+                'events': list(self._events),
+                'dropped_events': self._dropped,
+            }
+        if self.profile:
+            snapshot['profile'] = self.profile
+        return snapshot
+
+
+class TraceLog:
+    """Timeline events appended to a JSON-lines file, one event per line.
+
+    Lines are written whole, so worker processes can share the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            try:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    self._file = open(self.path, 'a', encoding='utf-8')
+                self._file.write(line)
+                self._file.flush()
+            except OSError as e:
+                print(f"Could not write trace log: {e}")
+
+
+class JobProfiler:
+    """cProfile capture for a random sample of jobs.
+
+    cProfile only sees the thread it runs in, and since Python 3.12 only one
+    profiler can be active at a time. So one thread at a time is profiled,
+    the first one of a sampled job to ask, and the results of successive
+    threads are merged into `directory`/<job id>.prof when the job finishes.
+    A thread that only waits for the job's other threads steps aside with
+    released(), so one of those gets profiled instead.
+    Profiling problems are printed and never stop a job.
+    """
+
+    def __init__(self, directory, sample_rate=0.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self._profiles = {}  # job id -> finished profiles of its threads
+        self._busy = False  # Whether some thread is being profiled
+        self._local = threading.local()  # .profile: the one running in this thread, if any
+        self._lock = threading.Lock()
+
+    def start(self, job_id):
+        """Decide whether to profile a job. Returns True if it is sampled."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return False
+        with self._lock:
+            self._profiles[job_id] = []
+        return True
+
+    def _enable(self, job_id):
+        """A running profile for the current thread, or None"""
+        with self._lock:
+            if job_id not in self._profiles or self._busy:
+                return None
+            self._busy = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except Exception as e:  # e.g. a debugger or another profiler is active
+            print(f"Could not profile job {job_id}: {e}")
+            with self._lock:
+                self._busy = False
+            return None
+        return profile
+
+    def _disable(self, job_id, profile):
+        profile.disable()
+        with self._lock:
+            self._busy = False
+            if job_id in self._profiles:
+                self._profiles[job_id].append(profile)
+
+    @contextlib.contextmanager
+    def thread(self, job_id):
+        """Profile the current thread while it works on job_id, if the job is sampled and no thread is"""
+        if getattr(self._local, 'profile', None) is not None:
+            yield  # Already profiled by an outer call
+            return
+        self._local.profile = self._enable(job_id)
+        try:
+            yield
+        finally:
+            profile, self._local.profile = self._local.profile, None
+            if profile is not None:
+                self._disable(job_id, profile)
+
+    @contextlib.contextmanager
+    def released(self, job_id):
+        """Stop profiling the current thread while it waits, so another thread of job_id can be"""
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            yield
+            return
+        self._local.profile = None
+        self._disable(job_id, profile)
+        try:
+            yield
+        finally:
+            # Picks up again unless a thread it waited for is still being profiled
+            self._local.profile = self._enable(job_id)
+
+    def wrap(self, job_id, function):
+        """function, profiled like thread() wherever it gets called"""
+        def profiled(*args, **kwargs):
+            with self.thread(job_id):
+                return function(*args, **kwargs)
+        return profiled
+
+    def finish(self, job_id):
+        """Save a sampled job's merged stats. Returns their path, or None."""
+        with self._lock:
+            profiles = self._profiles.pop(job_id, None)
+        if not profiles:
+            return None
+        path = os.path.join(self.directory, f'{job_id}.prof')
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(path)
+        except Exception as e:
+            print(f"Could not save the profile of job {job_id}: {e}")
+            return None
+        return path
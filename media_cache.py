@@ -0,0 +1,162 @@
+import collections
+import errno
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl request for copy-on-write clones on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def link_or_copy(source, destination):
+    """Materialize source at destination as cheaply as the filesystem allows"""
+    try:
+        os.link(source, destination)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    if fcntl is not None:
+        try:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+
+class MediaCache:
+    """Content-addressed store of finished media files shared by all jobs.
+
+    Each entry lives in <directory>/<key[:2]>/<key>/<filename>, keyed by the
+    video and the options that shape the output, and is evicted least
+    recently used first once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (file path, size)
+        self._total_bytes = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def make_key(video_key, options):
+        payload = json.dumps({'video': video_key, 'options': options}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load(self):
+        """Rebuild the index from disk, oldest access first"""
+        found = []
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                files = os.listdir(entry_dir) if os.path.isdir(entry_dir) else []
+                if len(files) != 1 or '.tmp-' in key:
+                    shutil.rmtree(entry_dir, ignore_errors=True)  # Interrupted store
+                    continue
+                path = os.path.join(entry_dir, files[0])
+                stat = os.stat(path)
+                found.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._entries[key] = (path, size)
+            self._total_bytes += size
+
+    def lookup(self, key):
+        """Path of the cached file for key, or None on a miss"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(entry[0]):
+                # Evicted by another worker process sharing the directory
+                del self._entries[key]
+                self._total_bytes -= entry[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(entry[0])  # Persist recency for the next restart
+        except OSError:
+            pass
+        return entry[0]
+
+    def materialize(self, key, output_dir):
+        """Place the cached file for key into output_dir, returning its path or None"""
+        cached_path = self.lookup(key)
+        if cached_path is None:
+            return None
+        os.makedirs(output_dir, exist_ok=True)
+        destination = os.path.join(output_dir, os.path.basename(cached_path))
+        try:
+            if not os.path.exists(destination):
+                link_or_copy(cached_path, destination)
+        except FileNotFoundError:
+            return None
+        return destination
+
+    def store(self, key, file_path):
+        """Add a freshly downloaded file to the cache"""
+        if not self.enabled or not os.path.isfile(file_path):
+            return
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            return
+        entry_dir = self._entry_dir(key)
+        temp_dir = f"{entry_dir}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(temp_dir)
+        try:
+            link_or_copy(file_path, os.path.join(temp_dir, os.path.basename(file_path)))
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another job stored the same key first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._entries[key] = (os.path.join(entry_dir, os.path.basename(file_path)), size)
+            self._total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, (path, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+class ProgressBroker:
+    """Wakes progress subscribers when a job changes.
+
+    Progress hooks can fire hundreds of times a second, so ordinary updates
+    are coalesced to at most one notification per min_interval per job.
+    Status transitions are published with force=True and never delayed.
+    """
+
+    def __init__(self, min_interval=0.5):
+        self.min_interval = min_interval
+        self._cond = threading.Condition()
+        self._versions = {}
+        self._last_publish = {}
+        self._pending = set()
+
+    def _bump(self, download_id, now):
+        self._pending.discard(download_id)
+        self._last_publish[download_id] = now
+        self._versions[download_id] = self._versions.get(download_id, 0) + 1
+        self._cond.notify_all()
+
+    def publish(self, download_id, force=False):
+        now = time.monotonic()
+        with self._cond:
+            if not force and now - self._last_publish.get(download_id, 0) < self.min_interval:
+                # Delivered by the next waiter once the interval has passed
+                self._pending.add(download_id)
+                return
+            self._bump(download_id, now)
+
+    def version(self, download_id):
+        with self._cond:
+            return self._versions.get(download_id, 0)
+
+    def wait(self, download_id, version, timeout):
+        """Block until the job's version moves past `version` or timeout expires.
+
+        Returns the current version, which equals `version` on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                current = self._versions.get(download_id, 0)
+                if current != version:
+                    return current
+                now = time.monotonic()
+                remaining = deadline - now
+                if download_id in self._pending:
+                    flush_at = self._last_publish.get(download_id, 0) + self.min_interval
+                    if now >= flush_at:
+                        self._bump(download_id, now)
+                        continue
+                    remaining = min(remaining, flush_at - now)
+                if remaining <= 0:
+                    return current
+                self._cond.wait(remaining)
+
+    def forget(self, download_id):
+        with self._cond:
+            self._versions.pop(download_id, None)
+            self._last_publish.pop(download_id, None)
+            self._pending.discard(download_id)
+            self._cond.notify_all()
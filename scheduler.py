@@ -0,0 +1,165 @@
+import collections
+import threading
+import time
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler has no room for another job"""
+
+
+class Job:
+    def __init__(self, download_id, target, args, group=None):
+        self.download_id = download_id
+        self.target = target
+        self.args = args
+        self.group = group
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = threading.Event()
+
+
+class DownloadScheduler:
+    """Fixed pool of worker threads fed from a bounded FIFO queue.
+
+    Jobs submitted together as a group share a concurrency limit: a job whose
+    group already has `limit` jobs running is passed over for later ones.
+    """
+
+    def __init__(self, workers=4, max_queue=50):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self._pending = collections.deque()
+        self._running = {}
+        self._groups = {}  # group -> [limit, running jobs, unfinished jobs]
+        self._cond = threading.Condition()
+        self._threads = []
+        # Moving average of job run time, used for wait estimates
+        self._avg_duration = None
+
+    def _ensure_workers(self):
+        # Workers are started lazily so importing the app never spawns threads
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True,
+                                      name=f"download-worker-{len(self._threads)}")
+            self._threads.append(thread)
+            thread.start()
+
+    def submit(self, download_id, target, *args):
+        """Queue a job, raising QueueFull when the queue is at capacity"""
+        return self.submit_group([(download_id, target) + args])[0]
+
+    def submit_group(self, jobs, group=None, limit=None):
+        """Queue (download_id, target, *args) tuples all at once or, if they do not fit, not at all.
+
+        With a group, at most `limit` of its jobs run at the same time.
+        """
+        with self._cond:
+            if len(self._pending) + len(jobs) > self.max_queue:
+                raise QueueFull(f"Download queue is full ({self.max_queue} jobs waiting)")
+            if group is not None:
+                entry = self._groups.setdefault(group, [None, 0, 0])
+                entry[0] = limit
+                entry[2] += len(jobs)
+            queued = [Job(job[0], job[1], job[2:], group) for job in jobs]
+            self._pending.extend(queued)
+            self._ensure_workers()
+            for _ in queued:
+                self._cond.notify()
+            return queued
+
+    def cancel(self, download_id):
+        """Cancel a queued or running job. Returns False if the job is unknown."""
+        with self._cond:
+            for job in self._pending:
+                if job.download_id == download_id:
+                    job.cancelled.set()
+                    self._pending.remove(job)
+                    self._leave_group(job)
+                    return True
+            job = self._running.get(download_id)
+            if job is None:
+                return False
+            # Running jobs notice this from their yt-dlp hooks
+            job.cancelled.set()
+            return True
+
+    def is_cancelled(self, download_id):
+        job = self._running.get(download_id)
+        return job is not None and job.cancelled.is_set()
+
+    def position(self, download_id):
+        """1-based position in the queue, or None if the job is not waiting"""
+        with self._cond:
+            for index, job in enumerate(self._pending):
+                if job.download_id == download_id:
+                    return index + 1
+        return None
+
+    def estimated_wait(self, download_id):
+        """Rough number of seconds until a queued job starts"""
+        position = self.position(download_id)
+        if position is None:
+            return 0
+        if self._avg_duration is None:
+            return None
+        rounds = (position + self.workers - 1) // self.workers
+        return round(rounds * self._avg_duration, 1)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'running': len(self._running),
+                'queued': len(self._pending),
+                'max_queue': self.max_queue,
+            }
+
+    def _next_job(self):
+        # Called with the lock held
+        for job in self._pending:
+            entry = self._groups.get(job.group)
+            if entry is None or entry[0] is None or entry[1] < entry[0]:
+                self._pending.remove(job)
+                if entry is not None:
+                    entry[1] += 1
+                return job
+        return None
+
+    def _leave_group(self, job):
+        # Called with the lock held
+        entry = self._groups.get(job.group)
+        if entry is None:
+            return
+        if job.started_at is not None:
+            entry[1] -= 1
+            # A group slot opened up, so a passed-over job may be runnable now
+            self._cond.notify()
+        entry[2] -= 1
+        if entry[2] == 0:
+            del self._groups[job.group]
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.started_at = time.time()
+                self._running[job.download_id] = job
+            try:
+                job.target(*job.args)
+            except Exception as e:
+                # Targets report their own errors; never let one kill the worker
+                print(f"Download job {job.download_id} crashed: {e}")
+            finally:
+                job.finished_at = time.time()
+                duration = job.finished_at - job.started_at
+                with self._cond:
+                    self._running.pop(job.download_id, None)
+                    self._leave_group(job)
+                    if self._avg_duration is None:
+                        self._avg_duration = duration
+                    else:
+                        self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
@@ -0,0 +1,219 @@
+"""Cancel and cleanup orderings of coalesced jobs, run offline against a stand-in download function.
+
+    python -m unittest test_coalescing
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
+
+_workdir = tempfile.mkdtemp(prefix='coalescing-test-')
+os.environ.update({
+    'DOWNLOAD_DIR': os.path.join(_workdir, 'downloads'),
+    'MEDIA_CACHE_DIR': os.path.join(_workdir, 'media_cache'),
+    'JOB_STORE': 'sqlite',
+    'JOB_STORE_PATH': os.path.join(_workdir, 'jobs.db'),
+    'STORE_FLUSH_INTERVAL': '3600',  # The tests flush themselves
+    'WARM_UP': '0',
+})
+
+import app  # noqa: E402
+import engine  # noqa: E402
+
+URL = 'http://media.invalid/clip.mp4'
+
+
+class FakeDownload:
+    """Stands in for download_single_video: runs until finish() or a cancellation"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.returned = threading.Event()
+        self.stopped_early = False
+
+    def __call__(self, url, download_id, **options):
+        try:
+            self.run(download_id)
+        finally:
+            self.returned.set()
+
+    def run(self, download_id):
+        progress = engine.download_status.get(download_id)
+        progress.status = 'downloading'
+        engine.notify_change(download_id, force=True)
+        self.started.set()
+        while not self.release.wait(0.01):
+            if engine.scheduler.is_cancelled(download_id):
+                self.stopped_early = True
+                progress.status = 'cancelled'
+                return
+        with open(os.path.join(engine.DOWNLOAD_DIR, download_id, 'clip.mp4'), 'wb') as f:
+            f.write(b'x' * 1000)
+        progress.status = 'completed'
+        progress.progress = 100
+
+    def finish(self):
+        self.release.set()
+
+
+class CoalescingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.download = FakeDownload()
+        patcher = mock.patch.dict(engine.DOWNLOAD_FUNCTIONS, {'single_video': self.download})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.download.finish)
+        self.client = app.app.test_client()
+        self.url = f'{URL}?{uuid.uuid4().hex}'  # Never coalesced with another test's job
+
+    def submit(self):
+        response = self.client.post('/download', json={'url': self.url, 'type': 'single_video'})
+        self.assertEqual(response.status_code, 200)
+        return response.json
+
+    def submit_pair(self):
+        owner = self.submit()['download_id']
+        self.assertTrue(self.download.started.wait(5))
+        follower = self.submit()
+        self.assertEqual(follower['shared_with'], owner)
+        return owner, follower['download_id']
+
+    def status(self, download_id):
+        response = self.client.get(f'/status/{download_id}')
+        return response.json['status'] if response.status_code == 200 else response.status_code
+
+    def wait_for(self, download_id, statuses=('completed', 'cancelled', 'error')):
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            status = self.status(download_id)
+            if status in statuses:
+                return status
+            time.sleep(0.01)
+        self.fail(f'{download_id} still {self.status(download_id)}')
+
+    def session_dir(self, download_id):
+        return os.path.join(engine.DOWNLOAD_DIR, download_id)
+
+    def test_follower_completes_after_owner_cancels(self):
+        owner, follower = self.submit_pair()
+        self.assertEqual(self.client.post(f'/cancel/{owner}').json['status'], 'cancelled')
+        self.download.finish()
+        self.assertEqual(self.wait_for(follower), 'completed')
+        self.assertFalse(self.download.stopped_early)
+        self.assertEqual(self.status(owner), 'cancelled')
+        self.assertEqual(self.client.get(f'/download/{owner}').status_code, 400)
+        self.assertEqual(self.client.get(f'/download/{follower}').status_code, 200)
+
+    def test_follower_completes_after_owner_cleans_up(self):
+        owner, follower = self.submit_pair()
+        self.client.post(f'/cleanup/{owner}')
+        self.assertEqual(self.status(owner), 404)
+        self.assertEqual(self.client.post(f'/cancel/{owner}').status_code, 404)
+        self.download.finish()
+        self.assertEqual(self.wait_for(follower), 'completed')
+        self.assertEqual(self.client.get(f'/download/{follower}').status_code, 200)
+
+        self.client.post(f'/cleanup/{follower}')
+        self.assertNotIn(owner, engine.download_status)
+        self.assertFalse(os.path.exists(self.session_dir(owner)))
+
+    def test_owner_completes_after_follower_cancels(self):
+        owner, follower = self.submit_pair()
+        self.assertEqual(self.client.post(f'/cancel/{follower}').json['status'], 'cancelled')
+        self.download.finish()
+        self.assertEqual(self.wait_for(owner), 'completed')
+        self.assertEqual(self.status(follower), 'cancelled')
+        self.assertEqual(self.client.get(f'/download/{owner}').status_code, 200)
+
+    def test_cancelling_every_submitter_stops_the_download(self):
+        for order in ('owner first', 'follower first'):
+            with self.subTest(order):
+                self.setUp()
+                owner, follower = self.submit_pair()
+                for download_id in ((owner, follower) if order == 'owner first' else (follower, owner)):
+                    self.client.post(f'/cancel/{download_id}')
+                self.assertEqual(self.wait_for(owner), 'cancelled')
+                self.assertEqual(self.wait_for(follower), 'cancelled')
+                self.assertTrue(self.download.returned.wait(5))
+                self.assertTrue(self.download.stopped_early)
+
+    def test_files_go_with_the_last_cleanup(self):
+        for order in ('owner first', 'follower first'):
+            with self.subTest(order):
+                self.setUp()
+                owner, follower = self.submit_pair()
+                self.download.finish()
+                self.wait_for(follower)
+                first, last = (owner, follower) if order == 'owner first' else (follower, owner)
+                self.client.post(f'/cleanup/{first}')
+                self.assertTrue(os.path.exists(self.session_dir(owner)))
+                self.assertEqual(self.client.get(f'/download/{last}').status_code, 200)
+                self.client.post(f'/cleanup/{last}')
+                self.assertFalse(os.path.exists(self.session_dir(owner)))
+                self.assertNotIn(owner, engine.download_status)
+                self.assertNotIn(follower, engine.download_status)
+
+    def test_cleanup_through_another_worker(self):
+        owner, follower = self.submit_pair()
+        self.download.finish()
+        self.wait_for(follower)
+        app.flush_job_store()
+
+        # What /cleanup/<owner> does in a worker process that does not run the job
+        with mock.patch.object(app, 'download_status', engine.JobRegistry()):
+            app.remove_job(owner)
+        self.assertIsNone(app.job_store.load(owner))
+        self.assertTrue(os.path.exists(self.session_dir(owner)))
+
+        app.flush_job_store()  # The owning worker notices the row is gone
+        self.assertEqual(self.status(owner), 404)
+        self.assertEqual(self.client.get(f'/download/{follower}').status_code, 200)
+        self.client.post(f'/cleanup/{follower}')
+        self.assertFalse(os.path.exists(self.session_dir(owner)))
+
+    def test_finished_job_cleaned_up_through_another_worker(self):
+        download_id = self.submit()['download_id']
+        self.download.finish()
+        self.wait_for(download_id)
+        app.flush_job_store()
+        app.job_store.delete(download_id)
+        app.flush_job_store()
+        self.assertNotIn(download_id, engine.download_status)
+        self.assertFalse(os.path.exists(self.session_dir(download_id)))
+
+    def test_reaper_frees_space_held_for_followers(self):
+        owner, follower = self.submit_pair()
+        self.client.post(f'/cleanup/{owner}')
+        self.download.finish()
+        self.wait_for(follower)
+        engine.download_status.get(owner).finished_at -= 1  # Evicted first
+        with mock.patch.object(app, 'DOWNLOAD_DIR_MAX_BYTES', 1):
+            app.reap_downloads()
+        self.assertNotIn(follower, engine.download_status)
+        self.assertFalse(os.path.exists(self.session_dir(owner)))
+
+    def test_reaper_leaves_released_jobs_to_their_followers(self):
+        owner, follower = self.submit_pair()
+        self.client.post(f'/cleanup/{owner}')
+        self.download.finish()
+        self.wait_for(follower)
+        with mock.patch.object(engine.download_status, 'expired', return_value=[owner]), \
+                mock.patch.object(app, 'detach_job') as detach_job:
+            app.reap_downloads()
+        detach_job.assert_not_called()
+        self.assertIn(owner, engine.download_status)
+        self.assertEqual(self.client.get(f'/download/{follower}').status_code, 200)
+
+
+def tearDownModule():
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
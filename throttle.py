@@ -0,0 +1,164 @@
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Responses that mean the host wants us to slow down
+THROTTLE_STATUSES = (403, 429)
+_STATUS_IN_MESSAGE = re.compile(r'HTTP Error (\d{3})')
+
+
+def url_host(url):
+    """Host a request to url goes to, without a leading www."""
+    host = (urlsplit(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+def is_throttled(error):
+    """Whether an exception (or anything it wraps) is a 403 or 429 response"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        status = getattr(error, 'status', None)
+        if status is None:
+            match = _STATUS_IN_MESSAGE.search(str(error))
+            status = int(match.group(1)) if match else None
+        if status in THROTTLE_STATUSES:
+            return True
+        exc_info = getattr(error, 'exc_info', None)
+        error = (getattr(error, 'cause', None) or error.__cause__ or error.__context__
+                 or (exc_info[1] if exc_info else None))
+    return False
+
+
+class HostBucket:
+    """Token bucket for one host whose refill rate adapts to how the host responds"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.backoffs = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class HostThrottle:
+    """Request rate limits per host, shared by every job.
+
+    Each host starts at `rate` requests per second with bursts of `burst`.
+    A throttled response halves the rate (down to `min_rate`) and pauses the
+    host for `pause` seconds; each successful request raises the rate by
+    `increase` again (up to `max_rate`), so hosts that never push back are
+    barely slowed down.
+    """
+
+    def __init__(self, rate=2.0, burst=3, min_rate=0.05, max_rate=10.0, increase=0.1, pause=10):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.pause = pause
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host):
+        # Called with the lock held
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = HostBucket(self.rate, self.burst)
+        return bucket
+
+    def acquire(self, host, should_stop=None):
+        """Wait for a request slot for host. Returns seconds waited, or None if should_stop() became true."""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                bucket = self._bucket(host)
+                now = time.monotonic()
+                bucket.refill(now)
+                if now >= bucket.paused_until and bucket.tokens >= 1:
+                    bucket.tokens -= 1
+                    return now - started
+                wait = max(bucket.paused_until - now, (1 - bucket.tokens) / bucket.rate)
+            if should_stop is not None and should_stop():
+                return None
+            time.sleep(min(wait, 0.5))
+
+    def success(self, host):
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+
+    def throttled(self, host):
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            bucket.tokens = 0
+            bucket.paused_until = time.monotonic() + self.pause
+            bucket.backoffs += 1
+
+    def state(self, host):
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                return {'host': host, 'requests_per_second': self.rate, 'paused_for': 0, 'backoffs': 0}
+            return {
+                'host': host,
+                'requests_per_second': round(bucket.rate, 3),
+                'paused_for': round(max(0, bucket.paused_until - time.monotonic()), 1),
+                'backoffs': bucket.backoffs,
+            }
+
+
+class BandwidthGovernor:
+    """Splits a total download rate evenly across jobs, and within a job across its downloads.
+
+    Attached yt-dlp params get their 'ratelimit' rewritten whenever a download
+    starts or stops, which running downloads pick up on their next chunk.
+    A limit of 0 disables the governor.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self._jobs = {}  # job id -> list of attached params
+        self._lock = threading.Lock()
+
+    def _rebalance(self):
+        # Called with the lock held
+        if not self._jobs:
+            return
+        per_job = self.limit / len(self._jobs)
+        for attached in self._jobs.values():
+            for params in attached:
+                params['ratelimit'] = max(1, int(per_job / len(attached)))
+
+    def attach(self, job_id, params):
+        if not self.limit:
+            return
+        with self._lock:
+            self._jobs.setdefault(job_id, []).append(params)
+            self._rebalance()
+
+    def detach(self, job_id, params):
+        if not self.limit:
+            return
+        with self._lock:
+            attached = [other for other in self._jobs.get(job_id, []) if other is not params]
+            params.pop('ratelimit', None)
+            self._jobs[job_id] = attached
+            if not attached:
+                self._jobs.pop(job_id, None)
+            self._rebalance()
+
+    def job_limit(self, job_id):
+        """Bytes per second a downloading job may use, or None when it is unlimited or not downloading"""
+        if not self.limit:
+            return None
+        with self._lock:
+            return int(self.limit / len(self._jobs)) if job_id in self._jobs else None
@@ -0,0 +1,209 @@
+import json
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# yt-dlp postprocessors that can be moved off the download threads
+SUPPORTED_POSTPROCESSORS = ('FFmpegExtractAudio', 'FFmpegVideoConvertor', 'FFmpegVideoRemuxer')
+
+# How a file was produced: left alone, stream-copied into a new container, or re-encoded
+METHOD_NONE = 'none'
+METHOD_REMUX = 'remux'
+METHOD_TRANSCODE = 'transcode'
+
+# Audio codecs delivered as they are with preferredcodec 'best', and the container each is copied into
+COPY_AUDIO_CODECS = {'aac': 'm4a', 'mp3': 'mp3', 'opus': 'opus'}
+# Codec used with preferredcodec 'best' when the source codec is not in COPY_AUDIO_CODECS
+FALLBACK_AUDIO_CODEC = 'mp3'
+
+AUDIO_ENCODERS = {
+    'mp3': 'libmp3lame',
+    'aac': 'aac',
+    'm4a': 'aac',
+    'opus': 'libopus',
+    'vorbis': 'libvorbis',
+    'flac': 'flac',
+    'wav': 'pcm_s16le',
+}
+AUDIO_EXTENSIONS = {'aac': 'm4a', 'vorbis': 'ogg'}
+
+# Streams that can be copied into an mp4 container without re-encoding
+MP4_VIDEO_CODECS = ('h264', 'hevc', 'av1', 'vp9', 'mpeg4')
+MP4_AUDIO_CODECS = ('aac', 'mp3', 'opus', 'ac3', 'eac3', 'flac', 'alac')
+
+
+class TranscodeCancelled(Exception):
+    """Raised when the owning job is cancelled while ffmpeg runs"""
+
+
+def probe_codecs(path, ffprobe='ffprobe'):
+    """First audio and video codec names of a media file, e.g. {'audio': 'aac', 'video': 'h264'}"""
+    output = subprocess.run(
+        [ffprobe, '-v', 'error', '-show_entries', 'stream=codec_type,codec_name', '-of', 'json', path],
+        stdin=subprocess.DEVNULL, capture_output=True, check=True,
+    ).stdout
+    codecs = {}
+    for stream in json.loads(output or '{}').get('streams', []):
+        codecs.setdefault(stream.get('codec_type'), stream.get('codec_name'))
+    return codecs
+
+
+def _quality_args(postprocessor):
+    quality = str(postprocessor.get('preferredquality') or '')
+    if quality.isdigit() and int(quality) > 10:
+        return ['-b:a', f'{quality}k']
+    return ['-q:a', quality] if quality else []
+
+
+def plan_conversion(source, postprocessor, probe):
+    """Cheapest way to apply a yt-dlp style postprocessor to source.
+
+    `probe` is called (at most once) for the source's codecs when the extension
+    alone cannot tell. Returns (method, ffmpeg arguments, destination), with no
+    arguments for METHOD_NONE.
+    """
+    base, ext = os.path.splitext(source)
+    ext = ext.lstrip('.').lower()
+    key = postprocessor['key']
+
+    if key == 'FFmpegExtractAudio':
+        codec = postprocessor.get('preferredcodec') or 'best'
+        if codec == 'best':
+            if ext in COPY_AUDIO_CODECS.values():
+                return METHOD_NONE, [], source  # Already a compatible audio file
+            source_codec = probe().get('audio')
+            if source_codec in COPY_AUDIO_CODECS:
+                return METHOD_REMUX, ['-vn', '-c:a', 'copy'], f'{base}.{COPY_AUDIO_CODECS[source_codec]}'
+            codec = FALLBACK_AUDIO_CODEC
+        target_ext = AUDIO_EXTENSIONS.get(codec, codec)
+        wanted_codec = 'aac' if codec == 'm4a' else codec
+        if ext == target_ext and probe().get('video') is None:
+            return METHOD_NONE, [], source
+        if probe().get('audio') == wanted_codec:
+            return METHOD_REMUX, ['-vn', '-c:a', 'copy'], f'{base}.{target_ext}'
+        return (METHOD_TRANSCODE, ['-vn', '-c:a', AUDIO_ENCODERS.get(codec, codec)] + _quality_args(postprocessor),
+                f'{base}.{target_ext}')
+
+    target_ext = postprocessor.get('preferedformat', 'mp4')
+    if ext == target_ext:
+        return METHOD_NONE, [], source
+    destination = f'{base}.{target_ext}'
+    if key == 'FFmpegVideoConvertor':
+        return METHOD_TRANSCODE, [], destination
+    if key == 'FFmpegVideoRemuxer':
+        if target_ext != 'mp4':
+            return METHOD_REMUX, ['-map', '0', '-dn', '-c', 'copy'], destination
+        # Copy whatever mp4 can hold and only re-encode the streams it cannot
+        codecs = probe()
+        video_ok = codecs.get('video') in MP4_VIDEO_CODECS + (None,)
+        audio_ok = codecs.get('audio') in MP4_AUDIO_CODECS + (None,)
+        args = ['-map', '0:v?', '-map', '0:a?', '-c:v', 'copy' if video_ok else 'libx264',
+                '-c:a', 'copy' if audio_ok else 'aac']
+        return (METHOD_REMUX if video_ok and audio_ok else METHOD_TRANSCODE), args, destination
+    raise ValueError(f"Unsupported postprocessor {key}")
+
+
+def run_ffmpeg(command, should_cancel=None):
+    """Run one ffmpeg process, terminating it if should_cancel() becomes true"""
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE)
+    while True:
+        try:
+            _, stderr = process.communicate(timeout=0.5)
+            break
+        except subprocess.TimeoutExpired:
+            if should_cancel and should_cancel():
+                process.kill()
+                process.communicate()
+                raise TranscodeCancelled("Conversion cancelled")
+    if process.returncode != 0:
+        message = stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {message[-1] if message else process.returncode}")
+
+
+def convert(source, postprocessor, should_cancel=None, ffmpeg=None, ffprobe=None):
+    """Apply a yt-dlp style postprocessor to source with ffmpeg.
+
+    Returns (final path, method), where method says whether the file was left
+    alone, remuxed or transcoded.
+    """
+    ffmpeg = ffmpeg or shutil.which('ffmpeg') or 'ffmpeg'
+    ffprobe = ffprobe or shutil.which('ffprobe') or 'ffprobe'
+    codecs = []
+
+    def probe():
+        if not codecs:
+            codecs.append(probe_codecs(source, ffprobe))
+        return codecs[0]
+
+    method, args, destination = plan_conversion(source, postprocessor, probe)
+    if method == METHOD_NONE:
+        return source, method
+    # Converting to the same extension (e.g. mp3 -> mp3 at another bitrate) needs a temporary name
+    output = f'{destination}.temp{os.path.splitext(destination)[1]}' if destination == source else destination
+    try:
+        run_ffmpeg([ffmpeg, '-y', '-loglevel', 'error', '-i', source] + args + [output], should_cancel)
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    if output != destination:
+        os.replace(output, destination)
+    else:
+        os.remove(source)
+    return destination, method
+
+
+class TranscodePool:
+    """Bounded stage that runs ffmpeg conversions while downloads continue.
+
+    At most `workers` ffmpeg processes run at once. Submissions beyond
+    `workers + backlog` block the submitting download thread, so a slow
+    conversion stage pushes back on downloading instead of filling the disk.
+    """
+
+    def __init__(self, workers, backlog):
+        self.workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='transcode')
+        self._slots = threading.BoundedSemaphore(self.workers + max(0, backlog))
+        self._lock = threading.Lock()
+        self.running = 0
+        self.pending = 0
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self._executor.submit(self._run, fn, *args)
+        except BaseException:
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(self._cancelled)
+        return future
+
+    def _cancelled(self, future):
+        # A future cancelled while queued never reaches _run, so give its slot back here
+        if future.cancelled():
+            with self._lock:
+                self.pending -= 1
+            self._slots.release()
+
+    def _run(self, fn, *args):
+        with self._lock:
+            self.pending -= 1
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'running': self.running, 'queued': self.pending}
@@ -0,0 +1,122 @@
+import contextlib
+import json
+import threading
+import time
+
+# Options that change from job to job; instances are shared across different values of these
+PER_JOB_OPTIONS = ('outtmpl', 'progress_hooks', 'postprocessor_hooks', 'playlist_items')
+
+
+def pool_key(ydl_opts):
+    """Identity of the yt-dlp instances that can serve ydl_opts"""
+    shared = {name: value for name, value in ydl_opts.items() if name not in PER_JOB_OPTIONS}
+    return json.dumps(shared, sort_keys=True, default=repr)
+
+
+class YoutubeDLPool:
+    """Reusable yt-dlp instances, keyed by their options.
+
+    Setting up a YoutubeDL (extractor lookup, postprocessors, cookies, HTTP
+    handlers) costs far more than a typical extraction, so idle instances are
+    kept and handed to the next job with the same options. The output template,
+    hooks and playlist item selection are swapped in on checkout. At most
+    `max_idle` instances are kept per option set, and an instance that raised
+    is closed rather than reused.
+
+    With `cookie_jars`, instances that use cookies get the shared jar from it
+    instead of loading the cookies themselves.
+    """
+
+    def __init__(self, max_idle=4, cookie_jars=None):
+        self.max_idle = max_idle
+        self.cookie_jars = cookie_jars
+        self._idle = {}  # pool key -> idle instances
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _create(self, ydl_opts):
+        import yt_dlp  # Imported on first use so starting the app stays fast
+
+        hooks = {'progress_hooks': [], 'postprocessor_hooks': []}
+        options = {name: value for name, value in ydl_opts.items() if name not in PER_JOB_OPTIONS}
+        # The instance keeps calling these, which forward to whichever job holds it
+        options['progress_hooks'] = [lambda d: [hook(d) for hook in hooks['progress_hooks']]]
+        options['postprocessor_hooks'] = [lambda d: [hook(d) for hook in hooks['postprocessor_hooks']]]
+        cookiejar = self.cookie_jars.get(ydl_opts) if self.cookie_jars is not None else None
+        ydl = yt_dlp.YoutubeDL(options)
+        if cookiejar is not None:
+            ydl.cookiejar = cookiejar  # Takes the place of yt-dlp's lazily loaded jar
+        ydl._pool_hooks = hooks
+        with self._lock:
+            self.created += 1
+        return ydl
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop()
+        return None
+
+    def _checkin(self, key, ydl):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(ydl)
+                return
+        ydl.close()
+
+    @contextlib.contextmanager
+    def acquire(self, ydl_opts, on_setup=None):
+        """YoutubeDL for ydl_opts, returned to the pool when the block exits.
+
+        on_setup(seconds, reused) is called once the instance is ready.
+        """
+        started = time.monotonic()
+        key = pool_key(ydl_opts)
+        ydl = self._checkout(key)
+        reused = ydl is not None
+        if ydl is None:
+            ydl = self._create(ydl_opts)
+        for name in ('progress_hooks', 'postprocessor_hooks'):
+            ydl._pool_hooks[name] = list(ydl_opts.get(name) or [])
+        ydl.params['outtmpl'] = ydl_opts.get('outtmpl') or {}
+        ydl.params['playlist_items'] = ydl_opts.get('playlist_items')
+        ydl._parse_outtmpl()
+        if on_setup is not None:
+            on_setup(time.monotonic() - started, reused)
+
+        try:
+            yield ydl
+        except BaseException:
+            ydl.close()
+            raise
+        else:
+            for name in ('progress_hooks', 'postprocessor_hooks'):
+                ydl._pool_hooks[name] = []
+            self._checkin(key, ydl)
+
+    def warm(self, ydl_opts):
+        """Create an idle instance for ydl_opts ahead of the first job that needs it"""
+        key = pool_key(ydl_opts)
+        with self._lock:
+            if self._idle.get(key):
+                return
+        self._checkin(key, self._create(ydl_opts))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'idle': sum(len(idle) for idle in self._idle.values()),
+                'created': self.created,
+                'reused': self.reused,
+            }
+
+    def close(self):
+        with self._lock:
+            idle = [ydl for instances in self._idle.values() for ydl in instances]
+            self._idle.clear()
+        for ydl in idle:
+            ydl.close()
@@ -0,0 +1,147 @@
+import os
+import struct
+import time
+import zlib
+
+CHUNK_SIZE = 1024 * 1024
+
+ZIP32_LIMIT = 0xFFFFFFFF
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+METHOD_STORED = 0
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+DATA_DESCRIPTOR64 = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_OF_CENTRAL_DIR = struct.Struct('<IHHHHIIH')
+END_OF_CENTRAL_DIR64 = struct.Struct('<IQHHIIQQQQ')
+END_OF_CENTRAL_DIR64_LOCATOR = struct.Struct('<IIQI')
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class _Member:
+    def __init__(self, path, arcname, offset):
+        stat = os.stat(path)
+        self.path = path
+        self.name = arcname.replace(os.sep, '/').encode('utf-8')
+        self.size = stat.st_size
+        self.time, self.date = _dos_datetime(stat.st_mtime)
+        self.offset = offset
+        self.crc = 0
+        self.zip64 = self.size >= ZIP32_LIMIT
+
+    def local_header(self):
+        # Sizes are known up front, the CRC follows the data in a descriptor
+        extra = b''
+        size = self.size
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, self.size, self.size)
+            size = ZIP32_LIMIT
+        return LOCAL_HEADER.pack(
+            0x04034b50, 45 if self.zip64 else 20, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+            METHOD_STORED, self.time, self.date, 0, size, size, len(self.name), len(extra),
+        ) + self.name + extra
+
+    def data_descriptor(self):
+        if self.zip64:
+            return DATA_DESCRIPTOR64.pack(0x08074b50, self.crc, self.size, self.size)
+        return DATA_DESCRIPTOR.pack(0x08074b50, self.crc, self.size, self.size)
+
+    def central_header(self):
+        zip64_fields = []
+        size = self.size
+        offset = self.offset
+        if self.zip64:
+            zip64_fields += [self.size, self.size]
+            size = ZIP32_LIMIT
+        if self.offset >= ZIP32_LIMIT:
+            zip64_fields.append(self.offset)
+            offset = ZIP32_LIMIT
+        extra = b''
+        if zip64_fields:
+            extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields)
+        version = 45 if zip64_fields else 20
+        return CENTRAL_HEADER.pack(
+            0x02014b50, (3 << 8) | version, version, FLAG_DATA_DESCRIPTOR | FLAG_UTF8,
+            METHOD_STORED, self.time, self.date, self.crc, size, size, len(self.name), len(extra),
+            0, 0, 0, 0o100644 << 16, offset,
+        ) + self.name + extra
+
+    def local_length(self):
+        descriptor = DATA_DESCRIPTOR64.size if self.zip64 else DATA_DESCRIPTOR.size
+        return len(self.local_header()) + self.size + descriptor
+
+
+class ZipStream:
+    """Store-only ZIP archive generated on the fly from files on disk.
+
+    Media files are already compressed, so members are stored as-is and the
+    total archive size is known before the first byte is produced.
+    """
+
+    def __init__(self, files):
+        self.members = []
+        offset = 0
+        for path, arcname in files:
+            member = _Member(path, arcname, offset)
+            self.members.append(member)
+            offset += member.local_length()
+        self.central_dir_offset = offset
+        self.central_dir_size = sum(len(member.central_header()) for member in self.members)
+        self.size = self.central_dir_offset + self.central_dir_size + len(self._end_records())
+
+    @classmethod
+    def from_directory(cls, directory_path):
+        files = []
+        for root, dirs, names in os.walk(directory_path):
+            dirs.sort()
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                files.append((file_path, os.path.relpath(file_path, directory_path)))
+        return cls(files)
+
+    def _end_records(self):
+        count = len(self.members)
+        records = b''
+        needs_zip64 = (count >= 0xFFFF or self.central_dir_offset >= ZIP32_LIMIT
+                       or self.central_dir_size >= ZIP32_LIMIT)
+        if needs_zip64:
+            zip64_offset = self.central_dir_offset + self.central_dir_size
+            records += END_OF_CENTRAL_DIR64.pack(
+                0x06064b50, END_OF_CENTRAL_DIR64.size - 12, (3 << 8) | 45, 45, 0, 0,
+                count, count, self.central_dir_size, self.central_dir_offset,
+            )
+            records += END_OF_CENTRAL_DIR64_LOCATOR.pack(0x07064b50, 0, zip64_offset, 1)
+        records += END_OF_CENTRAL_DIR.pack(
+            0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(self.central_dir_size, ZIP32_LIMIT), min(self.central_dir_offset, ZIP32_LIMIT), 0,
+        )
+        return records
+
+    def __iter__(self):
+        for member in self.members:
+            yield member.local_header()
+            crc = 0
+            remaining = member.size
+            with open(member.path, 'rb') as f:
+                while remaining > 0:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f"{member.path} shrank while it was being archived")
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+            member.crc = crc
+            yield member.data_descriptor()
+        for member in self.members:
+            yield member.central_header()
+        yield self._end_records()